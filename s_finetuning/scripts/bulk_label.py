@@ -0,0 +1,277 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+import torch
+from train_new import load_config
+from inteference import load_inference_model, load_prompt_mode, generate_batch
+from prompt_template import compile_prompt_template
+from router_schema import validate_batch
+from tiny_model import ensure_tiny_model
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Label a large JSONL of queries with the fine-tuned router")
+    parser.add_argument("--input", required=True,
+                        help="JSONL file with a 'query' field per line and an optional 'user' object "
+                             "(name, email, company, company_domain); other fields are kept")
+    parser.add_argument("--output_dir", required=True, help="Directory for output shards and the manifest")
+    parser.add_argument("--shard_size", type=int, default=10000, help="Input rows per shard")
+    parser.add_argument("--num_workers", type=int, default=1, help="Worker processes, each with its own model")
+    parser.add_argument("--batch_size", type=int, default=8, help="Queries generated together by a worker")
+    parser.add_argument("--max_new_tokens", type=int, default=512)
+    parser.add_argument("--tiny", action="store_true", help="Use the tiny-model stand-in (no adapters)")
+    parser.add_argument("--model_id", default=None, help="Override model_id from the config")
+    parser.add_argument("--adapter_dir", default=None, help="LoRA adapters to load (default: output_dir from the config)")
+    return parser.parse_args()
+
+def shard_path(output_dir, shard_index):
+    return os.path.join(output_dir, f"shard-{shard_index:05d}.jsonl")
+
+def plan_shards(input_path, shard_size):
+    """One pass over the input recording the byte offset where each shard starts"""
+    offsets, rows = [], 0
+    with open(input_path, 'rb') as f:
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            if rows % shard_size == 0:
+                offsets.append(position)
+            rows += 1
+    return offsets, rows
+
+def load_or_create_manifest(args):
+    """
+    The manifest pins the shard layout to one input file and shard size, so a resumed
+    run cannot silently mix shards cut at different boundaries.
+    """
+    manifest_path = os.path.join(args.output_dir, "manifest.json")
+    stat = os.stat(args.input)
+    source = {"input": os.path.abspath(args.input), "input_bytes": stat.st_size, "shard_size": args.shard_size}
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if {k: manifest[k] for k in source} != source:
+            print(f"❌ {args.output_dir} was created for a different input or shard size: {manifest_path}")
+            return None
+        return manifest
+
+    print(f"📏 Planning shards for {args.input}...")
+    offsets, rows = plan_shards(args.input, args.shard_size)
+    manifest = dict(source, rows=rows, shard_offsets=offsets)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+def parse_row(line):
+    """(record, error) for one input line; error is None for a usable row"""
+    try:
+        record = json.loads(line)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        return {"input": line.decode("utf-8", errors="replace").rstrip("\r\n")}, f"invalid JSON: {e}"
+    if not isinstance(record, dict):
+        return {"input": record}, "row is not a JSON object"
+    if not isinstance(record.get("query"), str) or not record["query"].strip():
+        return record, "missing 'query' string"
+    if record.get("user") is not None and not isinstance(record["user"], dict):
+        return record, "'user' is not an object"
+    return record, None
+
+def read_shard(input_path, offset, shard_size):
+    """
+    (record, error) pairs for the rows of one shard. Malformed rows are returned with
+    their error instead of raising: the shard layout is fixed by the manifest, so a
+    row that raised would fail its shard on every rerun.
+    """
+    rows = []
+    with open(input_path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.strip():
+                continue
+            rows.append(parse_row(line))
+            if len(rows) == shard_size:
+                break
+    return rows
+
+def to_output_record(record, raw_output, parsed):
+    """parsed is the (label, schema errors, repaired) result of router_schema for raw_output"""
+    label, errors, repaired = parsed
+    output = dict(record)
+    output["label"] = label
+    output["valid_json"] = label is not None
+    output["schema_valid"] = label is not None and not errors
+    if errors:
+        output["schema_errors"] = errors
+    if label is None or repaired:
+        output["raw_output"] = raw_output
+    return output
+
+def error_record(record, error):
+    """Output row for an input row that could not be labeled"""
+    return dict(record, label=None, valid_json=False, schema_valid=False, error=error)
+
+def write_shard(path, records):
+    """Write to a temp file and rename, so a shard file only ever exists complete"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def worker_main(worker_id, model_settings, job, tasks, results):
+    if torch.cuda.is_available():
+        device_map = {"": worker_id % torch.cuda.device_count()}
+    else:
+        device_map = "cpu"
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // job["num_workers"]))
+
+    model, tokenizer = load_inference_model(device_map=device_map, **model_settings)
+    prompt_mode = load_prompt_mode(model_settings["adapter_dir"])
+    template = compile_prompt_template(tokenizer, prompt_mode)
+
+    while True:
+        shard_index = tasks.get()
+        if shard_index is None:
+            return
+        start_time = time.perf_counter()
+        rows = read_shard(job["input"], job["shard_offsets"][shard_index], job["shard_size"])
+        # Output rows stay in input order; malformed rows are written with their error
+        labeled = [error_record(record, error) if error else None for record, error in rows]
+        usable = [(i, record) for i, (record, error) in enumerate(rows) if error is None]
+        for start in range(0, len(usable), job["batch_size"]):
+            batch = usable[start:start + job["batch_size"]]
+            outputs = generate_batch(
+                model,
+                tokenizer,
+                [record["query"] for _, record in batch],
+                prompt_mode,
+                job["max_new_tokens"],
+                template=template,
+                users=[record.get("user") for _, record in batch],
+            )
+            for (i, record), output, parsed in zip(batch, outputs, validate_batch(outputs)):
+                labeled[i] = to_output_record(record, output, parsed)
+        write_shard(shard_path(job["output_dir"], shard_index), labeled)
+        results.put({
+            "worker": worker_id,
+            "shard": shard_index,
+            "rows": len(labeled),
+            "valid_json": sum(record["valid_json"] for record in labeled),
+            "schema_valid": sum(record["schema_valid"] for record in labeled),
+            "bad_rows": len(labeled) - len(usable),
+            "seconds": time.perf_counter() - start_time,
+        })
+
+def run_workers(pending, job, model_settings, num_workers):
+    """Feed pending shards to worker processes and collect per-shard stats as they finish"""
+    ctx = mp.get_context("spawn")
+    tasks, results = ctx.Queue(), ctx.Queue()
+    for shard_index in pending:
+        tasks.put(shard_index)
+    for _ in range(num_workers):
+        tasks.put(None)
+
+    workers = [ctx.Process(target=worker_main, args=(i, model_settings, job, tasks, results)) for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    stats = []
+    try:
+        while len(stats) < len(pending):
+            try:
+                result = results.get(timeout=5)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    print(f"❌ All workers exited with {len(pending) - len(stats)} shards left; rerun to resume")
+                    break
+                continue
+            stats.append(result)
+            print(f"  ✅ shard {result['shard']:05d}: {result['rows']} rows in {result['seconds']:.1f}s "
+                  f"(worker {result['worker']}, {len(stats)}/{len(pending)})")
+    finally:
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+    return stats
+
+def print_throughput(stats, wall_time):
+    print(f"\n{'Worker':<8}{'Shards':>8}{'Rows':>10}{'Busy (s)':>10}{'Rows/s':>10}")
+    print("─" * 46)
+    for worker_id in sorted({s["worker"] for s in stats}):
+        worker_stats = [s for s in stats if s["worker"] == worker_id]
+        rows = sum(s["rows"] for s in worker_stats)
+        busy = sum(s["seconds"] for s in worker_stats)
+        print(f"{worker_id:<8}{len(worker_stats):>8}{rows:>10}{busy:>10.1f}{rows / busy:>10.2f}")
+    total_rows = sum(s["rows"] for s in stats)
+    valid = sum(s["valid_json"] for s in stats)
+    schema_valid = sum(s["schema_valid"] for s in stats)
+    bad_rows = sum(s.get("bad_rows", 0) for s in stats)
+    print(f"\n📊 Aggregate: {total_rows} rows in {wall_time:.1f}s = {total_rows / wall_time:.2f} rows/s")
+    if total_rows:
+        print(f"🧾 Valid JSON labels: {valid}/{total_rows} ({valid / total_rows:.1%}), "
+              f"matching the router schema: {schema_valid}/{total_rows} ({schema_valid / total_rows:.1%})")
+    if bad_rows:
+        print(f"⚠️  {bad_rows} input rows could not be read; they are in the shards with an 'error' field")
+
+def main():
+    args = parse_args()
+    config = load_config()
+    if config is None:
+        return
+
+    manifest = load_or_create_manifest(args)
+    if manifest is None:
+        return
+
+    num_shards = len(manifest["shard_offsets"])
+    pending = [i for i in range(num_shards) if not os.path.exists(shard_path(args.output_dir, i))]
+    print(f"🏷️  BULK LABELING: {manifest['rows']} rows in {num_shards} shards of {args.shard_size}")
+    print(f"Already complete: {num_shards - len(pending)}, to do: {len(pending)}, workers: {args.num_workers}")
+    print(f"----------------------------")
+    if not pending:
+        print("✅ Nothing to do, all shards are complete!")
+        return
+
+    if args.tiny:
+        raw_data_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"])
+        model_settings = {"model_id": ensure_tiny_model(data_path=raw_data_path), "adapter_dir": args.adapter_dir, "torch_dtype": torch.float32}
+    else:
+        model_settings = {
+            "model_id": args.model_id or config["model_id"],
+            "adapter_dir": args.adapter_dir or os.path.join(os.path.dirname(__file__), '..', config["output_dir"]),
+        }
+    job = {
+        "input": args.input,
+        "output_dir": args.output_dir,
+        "shard_offsets": manifest["shard_offsets"],
+        "shard_size": args.shard_size,
+        "batch_size": args.batch_size,
+        "max_new_tokens": args.max_new_tokens,
+        "num_workers": args.num_workers,
+    }
+
+    start_time = time.perf_counter()
+    stats = run_workers(pending, job, model_settings, min(args.num_workers, len(pending)))
+    if stats:
+        print_throughput(stats, time.perf_counter() - start_time)
+
+    remaining = sum(not os.path.exists(shard_path(args.output_dir, i)) for i in range(num_shards))
+    if remaining:
+        print(f"⚠️  {remaining} shards still missing; rerun the same command to resume")
+    else:
+        print(f"✅ All {num_shards} shards written to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import dataclasses
+import json
+import os
+import random
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.distributed as dist
+from peft import get_peft_model_state_dict
+from safetensors.torch import save_file
+from transformers import TrainerCallback
+from transformers.trainer_utils import get_last_checkpoint
+from transformers.training_args import ParallelMode
+
+CHECKPOINT_RE = re.compile(r"^checkpoint-(\d+)$")
+
+def to_cpu(obj):
+    """Recursively copy every tensor in a (nested) state dict to CPU memory"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def rng_snapshot(args):
+    """
+    RNG states in the layout Trainer._load_rng_state expects: all devices' CUDA states
+    under DDP, only the current device's state otherwise (as Trainer._save_rng_state does)
+    """
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "cpu": torch.random.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        if args.parallel_mode == ParallelMode.DISTRIBUTED:
+            state["cuda"] = torch.cuda.random.get_rng_state_all()
+        else:
+            state["cuda"] = torch.cuda.random.get_rng_state()
+    return state
+
+def resolve_resume_checkpoint(resume, output_dir):
+    """Map the --resume flag to a checkpoint directory ('latest' picks the newest complete one)"""
+    if not resume:
+        return None
+    if resume == "latest":
+        checkpoint = get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+        if checkpoint is None:
+            print(f"⚠️  No checkpoint found in {output_dir}, starting from scratch")
+        return checkpoint
+    if not os.path.isdir(resume):
+        raise FileNotFoundError(f"Checkpoint {resume} does not exist")
+    return resume
+
+class AsyncAdapterCheckpointCallback(TrainerCallback):
+    """
+    Step-based checkpoints that contain only the LoRA adapter plus the optimizer,
+    scheduler, trainer state and RNG states, i.e. everything Trainer needs to
+    resume at the exact data position with resume_from_checkpoint.
+
+    The training loop only pays for copying the (small) adapter and optimizer
+    tensors to CPU; serialization, the atomic rename and rotation happen on a
+    background thread. At most one save is in flight, so host memory stays bounded.
+    """
+
+    def __init__(self, output_dir, save_steps, save_total_limit=None, async_save=True):
+        self.output_dir = output_dir
+        self.save_steps = save_steps
+        self.save_total_limit = save_total_limit
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_save else None
+        self.pending = None
+        self.stall_seconds = 0.0
+        self.write_seconds = 0.0
+        self.saves = 0
+
+    def on_step_end(self, args, state, control, model=None, optimizer=None, lr_scheduler=None, **kwargs):
+        if self.save_steps <= 0 or state.global_step % self.save_steps != 0:
+            return
+
+        start_time = time.perf_counter()
+        rng_states = [rng_snapshot(args)]
+        if args.world_size > 1 and dist.is_initialized():
+            # Collective call: every rank reaches on_step_end at the same global step
+            rng_states = [None] * args.world_size
+            dist.all_gather_object(rng_states, rng_snapshot(args))
+
+        if state.is_world_process_zero:
+            unwrapped = model.module if hasattr(model, "module") else model
+            snapshot = {
+                "step": state.global_step,
+                "adapter": to_cpu(get_peft_model_state_dict(unwrapped)),
+                "peft_config": unwrapped.peft_config[unwrapped.active_adapter],
+                "optimizer": to_cpu(optimizer.state_dict()),
+                "scheduler": lr_scheduler.state_dict() if lr_scheduler is not None else None,
+                "trainer_state": json.dumps(dataclasses.asdict(state), indent=2, sort_keys=True) + "\n",
+                "rng_states": rng_states,
+            }
+            # Back-pressure: never queue more than one checkpoint
+            self.wait()
+            if self.executor is not None:
+                self.pending = self.executor.submit(self._write, snapshot)
+            else:
+                self._write(snapshot)
+        self.stall_seconds += time.perf_counter() - start_time
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.wait()
+        if state.is_world_process_zero and self.saves:
+            print(f"💾 {self.saves} adapter checkpoints written: {self.write_seconds:.2f}s of I/O, "
+                  f"{self.stall_seconds:.2f}s of training time spent on checkpointing")
+
+    def wait(self):
+        """Block until the in-flight checkpoint (if any) is on disk; re-raises write errors"""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def _write(self, snapshot):
+        start_time = time.perf_counter()
+        final_dir = os.path.join(self.output_dir, f"checkpoint-{snapshot['step']}")
+        tmp_dir = final_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        save_file(snapshot["adapter"], os.path.join(tmp_dir, "adapter_model.safetensors"), metadata={"format": "pt"})
+        snapshot["peft_config"].save_pretrained(tmp_dir)
+        torch.save(snapshot["optimizer"], os.path.join(tmp_dir, "optimizer.pt"))
+        if snapshot["scheduler"] is not None:
+            torch.save(snapshot["scheduler"], os.path.join(tmp_dir, "scheduler.pt"))
+        with open(os.path.join(tmp_dir, "trainer_state.json"), "w", encoding="utf-8") as f:
+            f.write(snapshot["trainer_state"])
+        rng_states = snapshot["rng_states"]
+        if len(rng_states) == 1:
+            torch.save(rng_states[0], os.path.join(tmp_dir, "rng_state.pth"))
+        else:
+            for process_index, rng_state in enumerate(rng_states):
+                torch.save(rng_state, os.path.join(tmp_dir, f"rng_state_{process_index}.pth"))
+
+        # A checkpoint directory only ever appears complete
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+        self._rotate()
+        self.saves += 1
+        self.write_seconds += time.perf_counter() - start_time
+
+    def _rotate(self):
+        if not self.save_total_limit:
+            return
+        checkpoints = sorted(
+            (int(m.group(1)), name)
+            for name in os.listdir(self.output_dir)
+            if (m := CHECKPOINT_RE.match(name))
+        )
+        for _, name in checkpoints[:-self.save_total_limit]:
+            shutil.rmtree(os.path.join(self.output_dir, name), ignore_errors=True)
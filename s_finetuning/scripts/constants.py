@@ -1,8 +1,8 @@
 from datetime import datetime
 
-def get_system_prompt():
+def get_system_prompt(current_date=None):
     """Generate system prompt with current date and time"""
-    current_date = datetime.now().strftime("%d %B %Y")
+    current_date = current_date or datetime.now().strftime("%d %B %Y")
     
     return f"""Search Query Prompt
 The current date is: Current Date : {current_date}. Based on this information, make your answers. Don't try to give vague answers without any logic. Be formal as much as possible.
@@ -335,5 +335,52 @@ Now handle the query as follows:
   14. If query is a follow up query then "isFollowUp" must be true.
   Make sure you always comply with these steps and only produce the JSON output described."""
 
+def get_compressed_system_prompt(current_date=None):
+    """Short variant of the system prompt for prompt-distilled models: output schema and enums only"""
+    current_date = current_date or datetime.now().strftime("%d %B %Y")
+
+    return f"""Enterprise search router. Current Date : {current_date}. Timezone: IST.
+Only respond in JSON:
+{{"answer":str|null,"queryRewrite":str|null,"temporalDirection":"next"|"prev"|null,"isFollowUp":bool,"type":"SearchWithoutFilters"|"SearchWithFilters"|"GetItems","filterQuery":str|null,"filters":{{"app":str|null,"entity":str|null,"count":int|null,"startTime":str|null,"endTime":str|null,"sortDirection":"asc"|"desc"|null,"intent":{{}}}}}}
+apps: gmail, google-drive, google-calendar, google-workspace, slack
+times: YYYY-MM-DDTHH:mm:ss.SSS+05:30"""
+
+def get_tag_prompt(current_date=None):
+    """Minimal tag for prompt-distilled models; keeps the date since time filters depend on it"""
+    current_date = current_date or datetime.now().strftime("%d %B %Y")
+
+    return f"<json_router> Current Date : {current_date}"
+
 # For backward compatibility, create the static version
 SYSTEM_PROMPT = get_system_prompt()
+
+# Prompt variants a model can be trained with: the full prompt, or a short form
+# the fine-tuned model learns to treat as the full prompt (prompt distillation)
+PROMPT_BUILDERS = {
+    "full": get_system_prompt,
+    "compressed": get_compressed_system_prompt,
+    "tag": get_tag_prompt,
+}
+PROMPT_MODES = {
+    "full": SYSTEM_PROMPT,
+    "compressed": get_compressed_system_prompt(),
+    "tag": get_tag_prompt(),
+}
+
+def format_user_content(user_query, prompt_mode="full", current_date=None):
+    """
+    User turn content shared by data prep, training and inference.
+    Uses the prompt built at import unless a current_date string is given.
+    """
+    if prompt_mode not in PROMPT_MODES:
+        raise ValueError(f"Unknown prompt_mode '{prompt_mode}', expected one of {list(PROMPT_MODES)}")
+    system_prompt = PROMPT_BUILDERS[prompt_mode](current_date) if current_date else PROMPT_MODES[prompt_mode]
+    return f"User Query: {user_query}\n\n{system_prompt}"
+
+# Gemma chat template shared by training and inference (roles: user / model)
+GEMMA_CHAT_TEMPLATE = """{% for message in messages %}{% if message['role'] == 'user' %}<start_of_turn>user
+{{ message['content'] }}<end_of_turn>
+{% elif message['role'] == 'model' %}<start_of_turn>model
+{{ message['content'] }}<end_of_turn>
+{% else %}{{ raise_exception('Unknown role: ' ~ message['role']) }}{% endif %}{% endfor %}{% if add_generation_prompt %}<start_of_turn>model
+{% endif %}"""
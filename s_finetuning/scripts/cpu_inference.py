@@ -0,0 +1,232 @@
+import argparse
+import copy
+import io
+import json
+import os
+import time
+import warnings
+import torch
+from peft import PeftModel
+from transformers.generation.streamers import BaseStreamer
+from train_new import load_config
+from inteference import load_inference_model, load_prompt_mode, generate_response
+from prompt_template import compile_prompt_template, request_values
+from evaluate import evaluate_adapter
+from tiny_model import ensure_tiny_model
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU inference with dynamic int8 quantization")
+    parser.add_argument("--tiny", action="store_true", help="Use the tiny-model stand-in as the base model")
+    parser.add_argument("--model_id", default=None, help="Override model_id from the config")
+    parser.add_argument("--adapter_dir", default=None, help="LoRA adapters to merge (default: output_dir, none with --tiny)")
+    parser.add_argument("--no_quantize", action="store_true", help="Keep fp32 linear layers")
+    parser.add_argument("--quantize_lm_head", action="store_true",
+                        help="Also quantize the output projection (smaller, but logits lose precision)")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the forward pass")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads (default: all CPUs in the affinity set)")
+    parser.add_argument("--cpu_affinity", default=None, help="Pin the process to these CPUs, e.g. '0-7' or '0,2,4,6'")
+    parser.add_argument("--benchmark", action="store_true", help="Compare fp32, int8 (and compiled) latency and accuracy")
+    parser.add_argument("--eval_file", default=None, help="Held-out raw samples (default: dataset_config.eval_data_output)")
+    parser.add_argument("--limit", type=int, default=32, help="Eval samples used by --benchmark")
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--query", action="append", default=None, help="Query to run (repeatable)")
+    return parser.parse_args()
+
+def parse_cpu_list(spec):
+    """'0-3,8,10-11' -> {0, 1, 2, 3, 8, 10, 11}"""
+    cpus = set()
+    for part in spec.split(","):
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+def configure_cpu_threads(num_threads=None, cpu_affinity=None):
+    """
+    Pin the process to a CPU set and size the thread pools to it. One intra-op thread per
+    pinned core avoids oversubscription when several server processes share a node.
+    """
+    if cpu_affinity:
+        os.sched_setaffinity(0, parse_cpu_list(cpu_affinity))
+    available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    num_threads = num_threads or available
+    torch.set_num_threads(num_threads)
+    try:
+        # Generation is a sequential chain of ops, so inter-op parallelism only adds contention
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Already set once parallel work has started in this process
+    return num_threads
+
+def quantize_linear_layers(model, quantize_lm_head=False):
+    """Dynamic int8 quantization: int8 weights, activations quantized on the fly per batch"""
+    qconfig_spec = {
+        name: torch.ao.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and (quantize_lm_head or not name.endswith("lm_head"))
+    }
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favour of torchao, but still ships and works in eager mode
+        warnings.simplefilter("ignore")
+        return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+def load_cpu_model(model_id, adapter_dir=None, quantize=True, quantize_lm_head=False, compile=False):
+    """
+    Load an fp32 CPU model, merge LoRA adapters into the base weights (quantization
+    replaces nn.Linear, so adapters must be folded in first), then quantize and compile.
+    """
+    model, tokenizer = load_inference_model(model_id, device_map="cpu", torch_dtype=torch.float32)
+    if adapter_dir:
+        print(f"Merging PEFT adapters from: {adapter_dir}...")
+        model = PeftModel.from_pretrained(model, adapter_dir).merge_and_unload()
+    return optimize_for_cpu(model, quantize, quantize_lm_head, compile), tokenizer
+
+def optimize_for_cpu(model, quantize=True, quantize_lm_head=False, compile=False):
+    model.eval()
+    if quantize:
+        print("🔢 Applying dynamic int8 quantization to linear layers...")
+        model = quantize_linear_layers(model, quantize_lm_head)
+    if compile:
+        print("⚙️  Compiling the forward pass...")
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+class TokenTimer(BaseStreamer):
+    """Records when generate() emits each new token (its first put() is the prompt)"""
+
+    def __init__(self):
+        self.prompt_seen = False
+        self.times = []
+
+    def put(self, value):
+        if self.prompt_seen:
+            self.times.append(time.perf_counter())
+        self.prompt_seen = True
+
+    def end(self):
+        pass
+
+def time_generation(model, tokenizer, template, queries, max_new_tokens):
+    """
+    Prefill latency (time to the first token) and decode throughput (tokens after the
+    first over the time between the first and last token), from per-token timestamps of
+    one generation per query. Queries with fewer than two tokens or a non-positive
+    decode time are not valid decode measurements and are left out of the average.
+    """
+    prefill_times, decode_rates = [], []
+    for query in queries:
+        input_ids = torch.tensor([template.encode(request_values(query))])
+        timer = TokenTimer()
+        start_time = time.perf_counter()
+        with torch.inference_mode():
+            model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id,
+                streamer=timer,
+            )
+        prefill_times.append(timer.times[0] - start_time)
+        decode_time = timer.times[-1] - timer.times[0]
+        if len(timer.times) > 1 and decode_time > 0:
+            decode_rates.append((len(timer.times) - 1) / decode_time)
+    if len(decode_rates) < len(queries):
+        print(f"⚠️  {len(queries) - len(decode_rates)}/{len(queries)} decode measurements were invalid and skipped")
+    return {
+        "prefill_ms": 1000 * sum(prefill_times) / len(prefill_times),
+        "decode_tokens_per_s": sum(decode_rates) / len(decode_rates) if decode_rates else float("nan"),
+    }
+
+def benchmark(args, model_id, adapter_dir, eval_data):
+    base_model, tokenizer = load_inference_model(model_id, device_map="cpu", torch_dtype=torch.float32)
+    if adapter_dir:
+        base_model = PeftModel.from_pretrained(base_model, adapter_dir).merge_and_unload()
+    base_model.eval()
+    prompt_mode = load_prompt_mode(adapter_dir)
+    template = compile_prompt_template(tokenizer, prompt_mode)
+
+    variants = {"fp32": base_model, "int8": quantize_linear_layers(base_model, args.quantize_lm_head)}
+    if args.compile:
+        variants["int8+compile"] = optimize_for_cpu(copy.deepcopy(variants["int8"]), quantize=False, compile=True)
+
+    timing_queries = [item["query"] for item in eval_data[:8]]
+    results, outputs = {}, {}
+    for name, model in variants.items():
+        print(f"\n⏱️  {name}...")
+        # Warm-up pass at the timed length so one-off costs (compilation and dynamic-shape
+        # recompiles, allocator growth) are not timed
+        time_generation(model, tokenizer, template, timing_queries[:1], args.max_new_tokens)
+        results[name] = time_generation(model, tokenizer, template, timing_queries, args.max_new_tokens)
+        results[name]["size_mb"] = model_size_mb(model)
+        metrics, outputs[name] = evaluate_adapter(model, tokenizer, eval_data, prompt_mode, 8, args.max_new_tokens, return_outputs=True)
+        results[name].update(metrics)
+
+    for name in variants:
+        # Greedy outputs identical to fp32: a direct measure of quantization damage even for untrained models
+        results[name]["matches_fp32"] = sum(a == b for a, b in zip(outputs[name], outputs["fp32"])) / len(eval_data)
+    return results
+
+def print_benchmark(results, num_threads):
+    names = list(results)
+    print(f"\n🖥️  CPU inference benchmark ({num_threads} threads)")
+    print(f"{'Metric':<22}" + "".join(f"{name:>14}" for name in names))
+    print("─" * (22 + 14 * len(names)))
+    rows = [
+        ("size_mb", ".1f"),
+        ("prefill_ms", ".1f"),
+        ("decode_tokens_per_s", ".1f"),
+        ("seconds_per_sample", ".3f"),
+        ("valid_json", ".1%"),
+        ("schema_valid", ".1%"),
+        ("routing_exact_match", ".1%"),
+        ("matches_fp32", ".1%"),
+    ]
+    for key, fmt in rows:
+        print(f"{key:<22}" + "".join(f"{format(results[name][key], fmt):>14}" for name in names))
+
+def main():
+    args = parse_args()
+    config = load_config()
+    if config is None:
+        return
+
+    num_threads = configure_cpu_threads(args.num_threads, args.cpu_affinity)
+    print(f"🖥️  CPU INFERENCE: {num_threads} threads, affinity {sorted(os.sched_getaffinity(0))}")
+    print(f"----------------------------")
+
+    if args.tiny:
+        model_id = ensure_tiny_model(data_path=os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"]))
+        adapter_dir = args.adapter_dir
+    else:
+        model_id = args.model_id or config["model_id"]
+        adapter_dir = args.adapter_dir or os.path.join(os.path.dirname(__file__), '..', config["output_dir"])
+
+    if args.benchmark:
+        eval_path = args.eval_file or os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["eval_data_output"])
+        if not os.path.exists(eval_path):
+            print(f"❌ Eval file not found: {eval_path}")
+            return
+        with open(eval_path, 'r') as f:
+            eval_data = json.load(f)[:args.limit]
+        results = benchmark(args, model_id, adapter_dir, eval_data)
+        print_benchmark(results, num_threads)
+        return
+
+    model, tokenizer = load_cpu_model(model_id, adapter_dir, not args.no_quantize, args.quantize_lm_head, args.compile)
+    prompt_mode = load_prompt_mode(adapter_dir)
+    template = compile_prompt_template(tokenizer, prompt_mode)
+    for query in args.query or ["Show me all emails from alice@example.com about project X from last month."]:
+        start_time = time.perf_counter()
+        output = generate_response(model, tokenizer, query, prompt_mode, template=template,
+                                   max_new_tokens=args.max_new_tokens, do_sample=False)
+        print(f"\n--- Query ---\n{query}")
+        print(f"--- Response ({time.perf_counter() - start_time:.2f}s) ---\n{output}")
+
+if __name__ == "__main__":
+    main()
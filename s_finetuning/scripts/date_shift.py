@@ -0,0 +1,277 @@
+import argparse
+import calendar
+import json
+import os
+import random
+import re
+from datetime import date, datetime, time, timedelta
+from torch.utils.data import IterableDataset, get_worker_info
+from constants import format_user_content
+from prompt_template import render_user_content
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+NUMBER_WORDS = {
+    "a": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "twelve": 12, "fourteen": 14, "thirty": 30,
+}
+NUMBER = r"(\d+|" + "|".join(NUMBER_WORDS) + r")"
+UNIT = r"(hour|day|week|month|quarter|year)s?"
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+def add_months(day, months):
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+def shift(day, amount, unit):
+    """day moved by amount units (negative = back in time)"""
+    if unit == "day":
+        return day + timedelta(days=amount)
+    if unit == "week":
+        return day + timedelta(weeks=amount)
+    months = {"month": 1, "quarter": 3, "year": 12}[unit]
+    return add_months(day, amount * months)
+
+def calendar_period(day, unit, offset=0):
+    """First and last day of the calendar week/month/quarter/year containing day, moved by offset periods"""
+    if unit == "week":
+        start = day - timedelta(days=day.weekday()) + timedelta(weeks=offset)
+        return start, start + timedelta(days=6)
+    if unit == "month":
+        start = add_months(day.replace(day=1), offset)
+        return start, add_months(start, 1) - timedelta(days=1)
+    if unit == "quarter":
+        start = add_months(day.replace(month=3 * ((day.month - 1) // 3) + 1, day=1), 3 * offset)
+        return start, add_months(start, 3) - timedelta(days=1)
+    start = date(day.year + offset, 1, 1)
+    return start, date(day.year + offset, 12, 31)
+
+def day_start(day):
+    return datetime.combine(day, time.min)
+
+def day_end(day):
+    return datetime.combine(day, time(23, 59, 59))
+
+def to_number(text):
+    return int(text) if text.isdigit() else NUMBER_WORDS[text]
+
+# Rules follow the conventions of the Gemini rewrite in prepare_data.py: rolling windows
+# ("last 3 days", "the past month", "last week") end today, bare calendar references
+# ("last month", "this year", "next quarter") use whole calendar periods, forward
+# windows ("next week", "next 5 days") start tomorrow. Earlier rules win.
+def _last_n(now, match):
+    amount, unit = to_number(match.group(1)), match.group(2)
+    if unit == "hour":
+        return now - timedelta(hours=amount), day_end(now.date())
+    return day_start(shift(now.date(), -amount, unit)), day_end(now.date())
+
+def _rolling(now, match):
+    unit = match.group(1)
+    if unit == "day":
+        return day_start(now.date() - timedelta(days=1)), day_end(now.date())
+    return day_start(shift(now.date(), -1, unit)), day_end(now.date())
+
+def _next_n(now, match):
+    amount, unit = to_number(match.group(1)), match.group(2)
+    if unit == "hour":
+        return now, now + timedelta(hours=amount)
+    return day_start(now.date() + timedelta(days=1)), day_end(shift(now.date(), amount, unit))
+
+def _next_week(now, match):
+    return day_start(now.date() + timedelta(days=1)), day_end(now.date() + timedelta(weeks=1))
+
+def _calendar(offset):
+    def rule(now, match):
+        start, end = calendar_period(now.date(), match.group(1), offset)
+        return day_start(start), day_end(end)
+    return rule
+
+def _single_day(days):
+    def rule(now, match):
+        day = now.date() + timedelta(days=days)
+        return day_start(day), day_end(day)
+    return rule
+
+def _last_weekday(now, match):
+    days_back = (now.date().weekday() - WEEKDAYS.index(match.group(1))) % 7 or 7
+    day = now.date() - timedelta(days=days_back)
+    return day_start(day), day_end(day)
+
+def _older_than(now, match):
+    return None, day_end(shift(now.date(), -to_number(match.group(1)), match.group(2)))
+
+RELATIVE_DATE_RULES = [
+    (re.compile(rf"\b(?:last|past|previous)\s+{NUMBER}\s+{UNIT}\b"), _last_n),
+    (re.compile(rf"\bnext\s+{NUMBER}\s+{UNIT}\b"), _next_n),
+    (re.compile(rf"\bolder\s+than\s+{NUMBER}\s+{UNIT}\b"), _older_than),
+    (re.compile(r"\b(?:the\s+(?:last|past)|past)\s+(day|week|month|quarter|year)\b"), _rolling),
+    (re.compile(r"\blast\s+(week)\b"), _rolling),
+    (re.compile(r"\blast\s+(" + "|".join(WEEKDAYS) + r")\b"), _last_weekday),
+    (re.compile(r"\b(?:last|previous)\s+(month|quarter|year)\b"), _calendar(-1)),
+    (re.compile(r"\bthis\s+(week|month|quarter|year)\b"), _calendar(0)),
+    (re.compile(r"\bnext\s+week\b"), _next_week),
+    (re.compile(r"\bnext\s+(month|quarter|year)\b"), _calendar(1)),
+    (re.compile(r"\b(?:today|tonight)\b"), _single_day(0)),
+    (re.compile(r"\byesterday\b"), _single_day(-1)),
+    (re.compile(r"\btomorrow\b"), _single_day(1)),
+]
+
+def recompute_time_filters(query, now):
+    """(startTime, endTime) strings for a relative date expression in the query, or None if none is recognized"""
+    lowered = query.lower()
+    for pattern, rule in RELATIVE_DATE_RULES:
+        match = pattern.search(lowered)
+        if match:
+            start, end = rule(now, match)
+            return (start.strftime(TIME_FORMAT) if start else None,
+                    end.strftime(TIME_FORMAT) if end else None)
+    return None
+
+def shift_label(item, now):
+    """
+    Router JSON for one raw example as if it were asked at `now`. Returns None when
+    the example has time filters that the rules cannot recompute; the date in its
+    label is tied to the prompt it was written for, so it must not be moved.
+    """
+    data = item["data"]
+    filters = data.get("filters") or {}
+    if filters.get("startTime") or filters.get("endTime"):
+        times = recompute_time_filters(item["query"], now)
+        if times is None:
+            return None
+        data = dict(data, filters=dict(filters, startTime=times[0], endTime=times[1]))
+    return data
+
+def shift_example(item, now, prompt_mode="full"):
+    """Chat messages for one raw example as if it were asked at `now`, or None (see shift_label)"""
+    data = shift_label(item, now)
+    if data is None:
+        return None
+
+    return [
+        {"role": "user", "content": render_user_content(item["query"], prompt_mode, now=now)},
+        {"role": "model", "content": json.dumps(data, separators=(',', ':'))},
+    ]
+
+def sample_datetime(rng, start_date, end_date):
+    """Uniformly random minute between start_date 00:00 and end_date 23:59"""
+    span_minutes = ((end_date - start_date).days + 1) * 24 * 60
+    return day_start(start_date) + timedelta(minutes=rng.randrange(span_minutes))
+
+class DateShiftDataset(IterableDataset):
+    """
+    Streams tokenized training examples from raw {"query", "data"} records, each asked at
+    a freshly sampled "current date": the date and time are rendered into the prompt and
+    relative startTime/endTime labels are recomputed for that date. Every epoch draws new
+    dates (seeded by seed, epoch and example index, so runs are reproducible and the
+    draws do not depend on the number of dataloader workers).
+
+    Examples with time filters the rules cannot recompute keep their original labels and
+    are prompted at reference_date, the date the dataset's labels were written for.
+    """
+
+    def __init__(self, raw_data, tokenizer, max_seq_length, prompt_mode="full",
+                 start_date="2024-01-01", end_date="2026-12-31", seed=42, shuffle=True,
+                 reference_date="2024-11-03"):
+        self.raw_data = raw_data
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.prompt_mode = prompt_mode
+        self.start_date = date.fromisoformat(str(start_date))
+        self.end_date = date.fromisoformat(str(end_date))
+        # Noon, so the rendered time is not a suspicious midnight
+        self.reference_now = datetime.combine(date.fromisoformat(str(reference_date)), time(12, 0))
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Called by the Trainer's dataloader at the start of every epoch"""
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.raw_data)
+
+    def example_messages(self, index, epoch=None):
+        rng = random.Random(f"{self.seed}-{self.epoch if epoch is None else epoch}-{index}")
+        now = sample_datetime(rng, self.start_date, self.end_date)
+        messages = shift_example(self.raw_data[index], now, self.prompt_mode)
+        if messages is None:
+            item = self.raw_data[index]
+            messages = [
+                {"role": "user", "content": render_user_content(item["query"], self.prompt_mode, now=self.reference_now)},
+                {"role": "model", "content": json.dumps(item["data"], separators=(',', ':'))},
+            ]
+        return messages
+
+    def __iter__(self):
+        order = list(range(len(self.raw_data)))
+        if self.shuffle:
+            random.Random(f"{self.seed}-{self.epoch}").shuffle(order)
+        worker = get_worker_info()
+        if worker is not None:
+            order = order[worker.id::worker.num_workers]
+        for index in order:
+            text = self.tokenizer.apply_chat_template(self.example_messages(index), tokenize=False)
+            input_ids = self.tokenizer(text, truncation=True, max_length=self.max_seq_length)["input_ids"]
+            yield {"input_ids": input_ids}
+
+def build_date_shift_dataset(config, tokenizer, max_seq_length, prompt_mode=None):
+    """DateShiftDataset over the raw training split (deduplicated, eval samples held out as in prepare_data.py)"""
+    from prepare_data import load_raw_data, split_eval
+    from dedup import deduplicate
+
+    raw_data_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"])
+    prompt_mode = prompt_mode or config["dataset_config"].get("prompt_mode", "full")
+    raw_data = load_raw_data(raw_data_path)
+    dedup_config = config.get("dedup_config", {})
+    if dedup_config.get("enabled", False):
+        raw_data, _ = deduplicate(raw_data, prompt_chars=len(format_user_content("", prompt_mode)), **dedup_config)
+    train_data, _ = split_eval(raw_data, config["dataset_config"].get("eval_fraction", 0))
+
+    date_shift_args = config.get("date_shift_args", {})
+    return DateShiftDataset(
+        train_data,
+        tokenizer,
+        max_seq_length,
+        prompt_mode=prompt_mode,
+        start_date=date_shift_args.get("start_date", "2024-01-01"),
+        end_date=date_shift_args.get("end_date", "2026-12-31"),
+        reference_date=date_shift_args.get("reference_date", "2024-11-03"),
+        seed=config["training_args"].get("seed", 42),
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Preview date-shift augmentation on the raw training data")
+    parser.add_argument("--num_examples", type=int, default=5, help="Time-filtered examples to show")
+    parser.add_argument("--date", default=None, help="Current date to shift to (YYYY-MM-DD, default: random)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    raw_data_path = os.path.join(os.path.dirname(__file__), '../training_data.json')
+    with open(raw_data_path, 'r') as f:
+        raw_data = json.load(f)
+
+    rng = random.Random(args.seed)
+    timed = [item for item in raw_data if item["data"]["filters"].get("startTime") or item["data"]["filters"].get("endTime")]
+    recognized = 0
+    shown = 0
+    for item in timed:
+        now = datetime.fromisoformat(args.date) if args.date else sample_datetime(rng, date(2024, 1, 1), date(2026, 12, 31))
+        times = recompute_time_filters(item["query"], now)
+        if times is None:
+            print(f"⚠️  Kept as is: {item['query']}")
+            continue
+        recognized += 1
+        if shown < args.num_examples:
+            shown += 1
+            filters = item["data"]["filters"]
+            print(f"\n📅 {now:%A %d %B %Y %H:%M}: {item['query']}")
+            print(f"   original: {filters.get('startTime')} → {filters.get('endTime')}")
+            print(f"   shifted:  {times[0]} → {times[1]}")
+
+    print(f"\n✅ {recognized}/{len(timed)} time-filtered examples are recomputed per epoch; "
+          f"{len(raw_data) - len(timed)} examples without time filters get a new date freely")
+
+if __name__ == "__main__":
+    main()
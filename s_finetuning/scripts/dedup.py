@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import re
+import time
+import numpy as np
+import yaml
+from colorama import Fore, Style
+
+# Values that make otherwise identical queries look different
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+DATE_RE = re.compile(
+    r"\d{4}-\d{2}-\d{2}(?:[T ][\d:.]+(?:[+-]\d{2}:?\d{2}|Z)?)?"
+    r"|\d{1,2}/\d{1,2}/\d{2,4}"
+    r"|(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.? \d{1,2}(?:st|nd|rd|th)?(?:,? \d{4})?"
+    r"|\d{1,2}(?:st|nd|rd|th)? (?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*(?:,? \d{4})?",
+    re.IGNORECASE,
+)
+NUMBER_RE = re.compile(r"\d+")
+NON_WORD_RE = re.compile(r"[^\w<>]+")
+
+# Mersenne prime and 32-bit mask for universal hashing (same scheme as datasketch)
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Label fields that decide whether two near-identical queries teach the model something different
+LABEL_FIELDS = ("type", "temporalDirection", "isFollowUp")
+LABEL_FILTER_FIELDS = ("app", "entity", "sortDirection")
+
+KEEP_RULES = ("first", "longest", "per_label")
+
+def normalize_query(text):
+    """Lowercase and mask emails, dates and numbers so they do not count as differences"""
+    if "@" in text:
+        text = EMAIL_RE.sub(" <email> ", text)
+    text = text.lower()
+    if NUMBER_RE.search(text):
+        text = NUMBER_RE.sub(" <num> ", DATE_RE.sub(" <date> ", text))
+    return NON_WORD_RE.sub(" ", text).strip()
+
+def shingle_hashes(text, shingle_size=4):
+    """Character n-gram shingles of a normalized query, packed into integers"""
+    data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+    if len(data) < shingle_size:
+        data = np.pad(data, (0, shingle_size - len(data)))
+    hashes = np.zeros(len(data) - shingle_size + 1, dtype=np.uint64)
+    for offset in range(shingle_size):
+        hashes = (hashes << np.uint64(8)) | data[offset:len(data) - shingle_size + 1 + offset]
+    return np.unique(hashes)
+
+def minhash_signatures(texts, num_perm=64, shingle_size=4, seed=1, chunk_size=4096):
+    """Compute MinHash signatures for all texts, vectorized over chunks of rows"""
+    rng = np.random.RandomState(seed)
+    perm_a = rng.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+    perm_b = rng.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for start in range(0, len(texts), chunk_size):
+        shingles = [shingle_hashes(text, shingle_size) for text in texts[start:start + chunk_size]]
+        offsets = np.cumsum([0] + [len(s) for s in shingles[:-1]])
+        flat = np.concatenate(shingles)
+        permuted = ((flat[None, :] * perm_a[:, None] + perm_b[:, None]) % MERSENNE_PRIME) & MAX_HASH
+        signatures[start:start + len(shingles)] = np.minimum.reduceat(permuted, offsets, axis=1).T
+    return signatures
+
+def lsh_candidate_pairs(signatures, bands=16):
+    """
+    Banded LSH: rows whose signatures agree on every hash of any band become candidates.
+    Each bucket is paired against its first member, so the cost stays linear in the row count.
+    """
+    num_rows, num_perm = signatures.shape
+    rows_per_band = num_perm // bands
+    rng = np.random.RandomState(0)
+    mix = rng.randint(1, (1 << 61) - 1, size=rows_per_band, dtype=np.uint64)
+
+    left, right = [], []
+    for band in range(bands):
+        band_sig = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+        keys = (band_sig * mix).sum(axis=1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        is_start = np.ones(num_rows, dtype=bool)
+        is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        bucket_first = order[np.maximum.accumulate(np.where(is_start, np.arange(num_rows), 0))]
+        members = ~is_start
+        left.append(bucket_first[members])
+        right.append(order[members])
+
+    if not left:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pairs = np.unique(np.stack([np.concatenate(left), np.concatenate(right)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+def find_clusters(num_rows, left, right):
+    """Union-find over the accepted pairs; returns a cluster id per row"""
+    parent = list(range(num_rows))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in zip(left.tolist(), right.tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    return np.array([find(i) for i in range(num_rows)])
+
+def label_key(item):
+    """Routing label of a raw entry (dates and free text are ignored)"""
+    data = item.get("data") or {}
+    filters = data.get("filters") or {}
+    return tuple(data.get(f) for f in LABEL_FIELDS) + tuple(filters.get(f) for f in LABEL_FILTER_FIELDS)
+
+def select_keepers(members, raw_data, keep="first", keep_per_cluster=1):
+    """Pick the rows to keep from one cluster (members are in original order)"""
+    if keep == "first":
+        return members[:keep_per_cluster]
+    if keep == "longest":
+        ranked = sorted(members, key=lambda i: -len(raw_data[i]["query"]))
+        return sorted(ranked[:keep_per_cluster])
+    if keep == "per_label":
+        kept, per_label = [], {}
+        for i in members:
+            key = label_key(raw_data[i])
+            if per_label.get(key, 0) < keep_per_cluster:
+                per_label[key] = per_label.get(key, 0) + 1
+                kept.append(i)
+        return kept
+    raise ValueError(f"Unsupported keep rule: {keep} (expected one of {KEEP_RULES})")
+
+def estimate_row_chars(raw_data, prompt_chars):
+    """Approximate characters each row contributes to a training sequence"""
+    output_chars = {}
+    row_chars = []
+    for item in raw_data:
+        key = id(item["data"])
+        if key not in output_chars:
+            output_chars[key] = len(json.dumps(item["data"], separators=(',', ':')))
+        row_chars.append(prompt_chars + len(item["query"]) + output_chars[key])
+    return row_chars
+
+def deduplicate(raw_data, threshold=0.8, num_perm=64, bands=16, shingle_size=4,
+                keep="first", keep_per_cluster=1, prompt_chars=0, **_):
+    """
+    Cluster near-duplicate queries and keep a few rows per cluster.
+    Exact duplicates after normalization are grouped directly; the remaining unique
+    texts go through MinHash + LSH, and candidates are accepted when their estimated
+    Jaccard similarity is at least `threshold`.
+    Returns (kept_rows, report).
+    """
+    if keep not in KEEP_RULES:
+        raise ValueError(f"Unsupported keep rule: {keep} (expected one of {KEEP_RULES})")
+    if num_perm % bands:
+        raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands})")
+
+    start_time = time.perf_counter()
+    # Exact duplicates after masking never need hashing
+    normalized, unique_ids = {}, {}
+    row_to_unique = np.empty(len(raw_data), dtype=np.int64)
+    for row, item in enumerate(raw_data):
+        query = item["query"]
+        if query not in normalized:
+            normalized[query] = normalize_query(query)
+        row_to_unique[row] = unique_ids.setdefault(normalized[query], len(unique_ids))
+    unique_texts = list(unique_ids)
+
+    signatures = minhash_signatures(unique_texts, num_perm=num_perm, shingle_size=shingle_size)
+    left, right = lsh_candidate_pairs(signatures, bands=bands)
+    similarity = (signatures[left] == signatures[right]).mean(axis=1)
+    accepted = similarity >= threshold
+    unique_cluster = find_clusters(len(unique_texts), left[accepted], right[accepted])
+
+    clusters = {}
+    for row, cluster_id in enumerate(unique_cluster[row_to_unique].tolist()):
+        clusters.setdefault(cluster_id, []).append(row)
+
+    kept_rows = []
+    for members in clusters.values():
+        kept_rows.extend(select_keepers(members, raw_data, keep, keep_per_cluster))
+    kept_rows.sort()
+    kept_set = set(kept_rows)
+    removed_rows = [i for i in range(len(raw_data)) if i not in kept_set]
+    removed = [raw_data[i] for i in removed_rows]
+
+    cluster_sizes = sorted((len(m) for m in clusters.values()), reverse=True)
+    row_chars = estimate_row_chars(raw_data, prompt_chars)
+    total_chars = sum(row_chars)
+    removed_chars = sum(row_chars[i] for i in removed_rows)
+    report = {
+        "rows_in": len(raw_data),
+        "rows_kept": len(kept_rows),
+        "rows_removed": len(removed),
+        "exact_duplicates": len(raw_data) - len(unique_texts),
+        "clusters": len(clusters),
+        "duplicate_clusters": sum(1 for size in cluster_sizes if size > 1),
+        "largest_cluster": cluster_sizes[0] if cluster_sizes else 0,
+        "candidate_pairs": int(len(left)),
+        "accepted_pairs": int(accepted.sum()),
+        # ~4 characters per token is close enough to compare runs
+        "est_tokens_saved_per_epoch": removed_chars // 4,
+        "compute_saved_pct": round(100 * removed_chars / total_chars, 2) if total_chars else 0.0,
+        "gemini_calls_saved": sum(
+            1 for item in removed
+            if item["data"]["filters"].get("startTime") or item["data"]["filters"].get("endTime")
+        ),
+        "seconds": round(time.perf_counter() - start_time, 3),
+    }
+    return [raw_data[i] for i in kept_rows], report
+
+def print_report(report):
+    print(f"{Fore.CYAN}🧹 Deduplication report:{Style.RESET_ALL}")
+    print(f"  Rows: {report['rows_in']} → {report['rows_kept']} ({report['rows_removed']} removed)")
+    print(f"  Clusters: {report['clusters']} ({report['duplicate_clusters']} with duplicates, largest {report['largest_cluster']})")
+    print(f"  Exact duplicates after masking: {report['exact_duplicates']}")
+    print(f"  LSH candidate pairs: {report['candidate_pairs']} ({report['accepted_pairs']} accepted)")
+    print(f"  Estimated training tokens saved per epoch: {report['est_tokens_saved_per_epoch']:,} "
+          f"({report['compute_saved_pct']}%)")
+    print(f"  Gemini calls saved: {report['gemini_calls_saved']}")
+    print(f"  Time: {report['seconds']}s")
+
+def synthesize_rows(raw_data, num_rows, seed=0):
+    """Blow up the dataset with email/date/wording variants to benchmark at scale"""
+    rng = np.random.RandomState(seed)
+    words = ["please", "quickly", "again", "now", "all", "my", "the", "recent"]
+    rows = []
+    for i in range(num_rows):
+        item = raw_data[rng.randint(len(raw_data))]
+        query = EMAIL_RE.sub(f"user{rng.randint(100000)}@example.com", item["query"])
+        query = f"{query} {rng.randint(1, 28)} Oct 2024"
+        if rng.rand() < 0.5:
+            # A word-level edit that masking cannot undo, so LSH has to catch it
+            tokens = query.split()
+            tokens.insert(rng.randint(len(tokens) + 1), words[rng.randint(len(words))] + str(i % 7))
+            query = " ".join(tokens)
+        rows.append({"query": query, "data": item["data"]})
+    return rows
+
+if __name__ == "__main__":
+    config_path = os.path.join(os.path.dirname(__file__), '../config/fine_tune_config.yaml')
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    dedup_config = config.get("dedup_config", {})
+
+    parser = argparse.ArgumentParser(description="Near-duplicate detection for raw training data")
+    parser.add_argument("--input", default=os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"]))
+    parser.add_argument("--output", default=None, help="Write the deduplicated rows to this file")
+    parser.add_argument("--threshold", type=float, default=dedup_config.get("threshold", 0.8))
+    parser.add_argument("--keep", choices=KEEP_RULES, default=dedup_config.get("keep", "first"))
+    parser.add_argument("--keep_per_cluster", type=int, default=dedup_config.get("keep_per_cluster", 1))
+    parser.add_argument("--benchmark", type=int, default=0, help="Synthesize this many rows and time the dedup")
+    args = parser.parse_args()
+
+    with open(args.input, 'r') as f:
+        raw_json_data = json.load(f)
+    if args.benchmark:
+        raw_json_data = synthesize_rows(raw_json_data, args.benchmark)
+        print(f"🧪 Benchmarking on {len(raw_json_data):,} synthesized rows")
+
+    dedup_args = dict(dedup_config, threshold=args.threshold, keep=args.keep, keep_per_cluster=args.keep_per_cluster)
+    deduped, dedup_report = deduplicate(raw_json_data, **dedup_args)
+    print_report(dedup_report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(deduped, f, indent=2, ensure_ascii=False)
+        print(f"{Fore.GREEN}Saved {len(deduped)} rows to {args.output}{Style.RESET_ALL}")
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+import torch
+from peft import PeftModel
+from train_new import load_config
+from inteference import load_inference_model, load_prompt_mode, generate_batch
+from prompt_template import compile_prompt_template, request_values
+from date_shift import shift_label
+from router_schema import validate_batch
+from tiny_model import ensure_tiny_model
+
+# Fields that drive routing; free-text fields (answer, queryRewrite) are only checked for null-ness
+ROUTING_FIELDS = [
+    "type",
+    "isFollowUp",
+    "temporalDirection",
+    "filterQuery",
+    "filters.app",
+    "filters.entity",
+    "filters.count",
+    "filters.startTime",
+    "filters.endTime",
+    "filters.sortDirection",
+    "filters.intent",
+]
+NULLABLE_TEXT_FIELDS = ["answer", "queryRewrite"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare router accuracy of adapters trained with different prompt modes")
+    parser.add_argument("--adapters", nargs="+", default=None,
+                        help="Adapter directories to compare (default: output_dir). Each uses the prompt mode it was trained with")
+    parser.add_argument("--eval_file", default=None, help="Held-out raw samples (default: dataset_config.eval_data_output)")
+    parser.add_argument("--tiny", action="store_true", help="Use the tiny-model stand-in as the base model")
+    parser.add_argument("--model_id", default=None, help="Override model_id from the config")
+    parser.add_argument("--limit", type=int, default=None, help="Evaluate only the first N samples")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--output", default=None, help="Write metrics to this JSON file")
+    return parser.parse_args()
+
+def get_field(data, path):
+    for key in path.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+def score_prediction(prediction, expected):
+    """Per-field correctness of one parsed prediction against the expected router JSON"""
+    fields = {path: get_field(prediction, path) == get_field(expected, path) for path in ROUTING_FIELDS}
+    for path in NULLABLE_TEXT_FIELDS:
+        fields[path] = (get_field(prediction, path) is None) == (get_field(expected, path) is None)
+    return fields
+
+def evaluate_adapter(model, tokenizer, eval_data, prompt_mode, batch_size, max_new_tokens, return_outputs=False, now=None):
+    """
+    Router accuracy of one adapter on raw held-out samples. Every prompt is rendered at
+    the same `now` (default: the current time), and relative startTime/endTime labels
+    are re-dated to it; labels the date rules cannot recompute (absolute dates) are
+    scored as stored.
+    """
+    now = now or datetime.now()
+    valid, schema_valid, repaired, exact, generation_time = 0, 0, 0, 0, 0.0
+    all_outputs = []
+    field_correct = {path: 0 for path in ROUTING_FIELDS + NULLABLE_TEXT_FIELDS}
+    template = compile_prompt_template(tokenizer, prompt_mode)
+    prompt_tokens = [len(template.encode(request_values(item["query"], now=now))) for item in eval_data]
+
+    for i in range(0, len(eval_data), batch_size):
+        batch = eval_data[i:i + batch_size]
+        start_time = time.perf_counter()
+        outputs = generate_batch(model, tokenizer, [item["query"] for item in batch], prompt_mode, max_new_tokens,
+                                 template=template, now=now)
+        generation_time += time.perf_counter() - start_time
+        all_outputs.extend(outputs)
+        # Predictions are scored after repair, as they would be served
+        for item, (prediction, errors, was_repaired) in zip(batch, validate_batch(outputs)):
+            if prediction is None:
+                continue
+            valid += 1
+            schema_valid += not errors
+            repaired += was_repaired
+            fields = score_prediction(prediction, shift_label(item, now) or item["data"])
+            for path, correct in fields.items():
+                field_correct[path] += correct
+            exact += all(fields.values())
+
+    n = len(eval_data)
+    metrics = {
+        "prompt_mode": prompt_mode,
+        "samples": n,
+        "mean_prompt_tokens": sum(prompt_tokens) / n,
+        "valid_json": valid / n,
+        "schema_valid": schema_valid / n,
+        "repaired": repaired / n,
+        "routing_exact_match": exact / n,
+        "field_accuracy": {path: correct / n for path, correct in field_correct.items()},
+        "seconds_per_sample": generation_time / n,
+    }
+    return (metrics, all_outputs) if return_outputs else metrics
+
+def print_comparison(results):
+    names = list(results)
+    width = max(14, *(len(os.path.basename(os.path.normpath(name))) + 2 for name in names))
+    header = f"{'Metric':<24}" + "".join(f"{os.path.basename(os.path.normpath(name)):>{width}}" for name in names)
+    print(f"\n{header}")
+    print("─" * len(header))
+
+    def row(label, values, fmt):
+        print(f"{label:<24}" + "".join(f"{format(v, fmt):>{width}}" for v in values))
+
+    row("prompt_mode", [results[n]["prompt_mode"] for n in names], "")
+    row("mean_prompt_tokens", [results[n]["mean_prompt_tokens"] for n in names], ".0f")
+    row("seconds_per_sample", [results[n]["seconds_per_sample"] for n in names], ".3f")
+    row("valid_json", [results[n]["valid_json"] for n in names], ".1%")
+    row("schema_valid", [results[n]["schema_valid"] for n in names], ".1%")
+    row("repaired", [results[n]["repaired"] for n in names], ".1%")
+    row("routing_exact_match", [results[n]["routing_exact_match"] for n in names], ".1%")
+    for path in ROUTING_FIELDS + NULLABLE_TEXT_FIELDS:
+        row(f"  {path}", [results[n]["field_accuracy"][path] for n in names], ".1%")
+
+def main():
+    args = parse_args()
+    config = load_config()
+    if config is None:
+        return
+
+    eval_path = args.eval_file or os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["eval_data_output"])
+    if not os.path.exists(eval_path):
+        print(f"❌ Eval file not found: {eval_path}")
+        print("   Set dataset_config.eval_fraction and rerun prepare_data.py, or pass --eval_file")
+        return
+    with open(eval_path, 'r') as f:
+        eval_data = json.load(f)[:args.limit]
+
+    adapters = args.adapters or [os.path.join(os.path.dirname(__file__), '..', config["output_dir"])]
+    if args.tiny:
+        model_id = ensure_tiny_model(data_path=os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"]))
+        torch_dtype = torch.float32
+    else:
+        model_id = args.model_id or config["model_id"]
+        torch_dtype = None
+
+    print(f"🧪 EVALUATION: {len(eval_data)} samples from {eval_path}")
+    print(f"----------------------------")
+    base_model, tokenizer = load_inference_model(model_id, torch_dtype=torch_dtype)
+
+    results = {}
+    for adapter_dir in adapters:
+        prompt_mode = load_prompt_mode(adapter_dir)
+        print(f"🔌 {adapter_dir} (prompt_mode: {prompt_mode})")
+        model = PeftModel.from_pretrained(base_model, adapter_dir).eval()
+        results[adapter_dir] = evaluate_adapter(model, tokenizer, eval_data, prompt_mode, args.batch_size, args.max_new_tokens)
+        # Detach the adapter so the next one starts from the clean base weights
+        base_model = model.unload()
+
+    print_comparison(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"📁 Evaluation results saved to: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,26 @@ import torch
 import yaml
 import os
 import json
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from threading import Thread
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
 from peft import PeftModel
-from .constants import SYSTEM_PROMPT
+from constants import GEMMA_CHAT_TEMPLATE
+from prompt_template import compile_prompt_template, render_user_content, request_values
+from router_schema import parse_output
 
-def main():
-    config_path = os.path.join(os.path.dirname(__file__), '../config/fine_tune_config.yaml')
-    with open(config_path, 'r') as f:
-        config = yaml.safe_load(f)
+# Written next to the adapters so inference uses the prompt form the model was trained with
+ROUTER_CONFIG_NAME = "router_config.json"
 
-    model_id = config["model_id"]
-    output_dir = os.path.join(os.path.dirname(__file__), '..', config["output_dir"])
-
-    compute_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+def load_inference_model(model_id, adapter_dir=None, device_map="auto", torch_dtype=None):
+    """Load the base model (plus LoRA adapters if given) and its tokenizer for generation"""
+    if torch_dtype is None:
+        torch_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
 
     print(f"Loading base model: {model_id}...")
-    base_model = AutoModelForCausalLM.from_pretrained(
+    model = AutoModelForCausalLM.from_pretrained(
         model_id,
-        torch_dtype=compute_dtype, 
-        device_map="auto",
+        torch_dtype=torch_dtype,
+        device_map=device_map,
     )
 
     print(f"Loading tokenizer for {model_id}...")
@@ -28,20 +29,111 @@ def main():
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
     tokenizer.padding_side = "right"
+    tokenizer.chat_template = GEMMA_CHAT_TEMPLATE
+
+    if adapter_dir:
+        print(f"Loading PEFT adapters from: {adapter_dir}...")
+        model = PeftModel.from_pretrained(model, adapter_dir)
+
+    model.eval()
+    return model, tokenizer
+
+def save_router_config(adapter_dir, prompt_mode):
+    """Record the prompt mode next to the adapters"""
+    with open(os.path.join(adapter_dir, ROUTER_CONFIG_NAME), "w") as f:
+        json.dump({"prompt_mode": prompt_mode}, f, indent=2)
+
+def load_prompt_mode(adapter_dir):
+    """Prompt mode the adapters were trained with ("full" for older adapters without a router config)"""
+    path = os.path.join(adapter_dir, ROUTER_CONFIG_NAME) if adapter_dir else None
+    if not path or not os.path.exists(path):
+        return "full"
+    with open(path, 'r') as f:
+        return json.load(f).get("prompt_mode", "full")
+
+def build_prompt(tokenizer, query, prompt_mode="full", now=None, user=None):
+    """Same user turn layout as prepare_data.py, followed by the model turn marker"""
+    messages = [{"role": "user", "content": render_user_content(query, prompt_mode, user, now)}]
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+def encode_prompts(tokenizer, queries, prompt_mode="full", template=None, user=None, now=None):
+    """
+    Token ids for each query, asked at `now` (default: the current time). With a compiled
+    template only the per-request values (query, date, time, user) are tokenized;
+    otherwise the prompt string is rebuilt.
+    """
+    if template is not None:
+        return [template.encode(request_values(query, user, now)) for query in queries]
+    prompts = [build_prompt(tokenizer, query, prompt_mode, now, user) for query in queries]
+    return tokenizer(prompts, add_special_tokens=False)["input_ids"]
+
+def stream_response(model, tokenizer, prompt, **generation_kwargs):
+    """
+    Yield decoded text chunks as they are generated (generation runs on a worker thread).
+    prompt is either the prompt string or its token ids.
+    """
+    if isinstance(prompt, str):
+        inputs = tokenizer(prompt, return_tensors="pt", add_special_tokens=False).to(model.device)
+    else:
+        input_ids = torch.tensor([prompt], device=model.device)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    generation_kwargs.setdefault("eos_token_id", [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")])
+    generation_kwargs.setdefault("pad_token_id", tokenizer.pad_token_id)
+
+    failure = []
+
+    def generate():
+        try:
+            with torch.inference_mode():
+                model.generate(**inputs, streamer=streamer, **generation_kwargs)
+        except Exception as e:
+            # Unblock the consumer, then re-raise on its side
+            failure.append(e)
+            streamer.end()
+
+    worker = Thread(target=generate, daemon=True)
+    worker.start()
+    yield from streamer
+    worker.join()
+    if failure:
+        raise failure[0]
+
+def generate_response(model, tokenizer, query, prompt_mode="full", template=None, user=None, **generation_kwargs):
+    """Run one query through the router and return the raw generated text"""
+    prompt_ids = encode_prompts(tokenizer, [query], prompt_mode, template, user)[0]
+    return "".join(stream_response(model, tokenizer, prompt_ids, **generation_kwargs)).strip()
+
+def generate_batch(model, tokenizer, queries, prompt_mode="full", max_new_tokens=512, template=None, users=None, now=None):
+    """Greedy-decode a batch of queries (left padded) and return the generated texts"""
+    if users is not None:
+        prompt_ids = [encode_prompts(tokenizer, [query], prompt_mode, template, user, now)[0] for query, user in zip(queries, users)]
+    else:
+        prompt_ids = encode_prompts(tokenizer, queries, prompt_mode, template, now=now)
+    inputs = tokenizer.pad({"input_ids": prompt_ids}, padding=True, padding_side="left", return_tensors="pt").to(model.device)
+    with torch.inference_mode():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_id=[tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")],
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    generated = outputs[:, inputs["input_ids"].shape[1]:]
+    return [text.strip() for text in tokenizer.batch_decode(generated, skip_special_tokens=True)]
 
-    print(f"Loading PEFT adapters from: {output_dir}...")
-    model_for_inference = PeftModel.from_pretrained(base_model, output_dir)
+def main():
+    config_path = os.path.join(os.path.dirname(__file__), '../config/fine_tune_config.yaml')
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
 
-    model_to_use = model_for_inference
+    model_id = config["model_id"]
+    output_dir = os.path.join(os.path.dirname(__file__), '..', config["output_dir"])
 
-    print("Creating text generation pipeline...")
-    pipe = pipeline(
-        "text-generation",
-        model=model_to_use,
-        tokenizer=tokenizer,
-        torch_dtype=compute_dtype,
-        device_map="auto",
-    )
+    model, tokenizer = load_inference_model(model_id, output_dir)
+    prompt_mode = load_prompt_mode(output_dir)
+    template = compile_prompt_template(tokenizer, prompt_mode)
+    print(f"Prompt mode: {prompt_mode} ({template.static_tokens} static prompt tokens cached)")
 
     print("\n--- Testing Inference ---")
     test_queries = [
@@ -53,36 +145,32 @@ def main():
     ]
 
     for query in test_queries:
-        prompt = f"{SYSTEM_PROMPT}\\n\\nUser Query: {query}\\n\\n### Assistant:"
-        print(f"\\n--- Query ---\\n{query}")
-        print(f"--- Prompt Sent to Model ---\\n{prompt}")
-
-        stop_token_ids = [tokenizer.eos_token_id]
-
-        outputs = pipe(
-            prompt,
-            max_new_tokens=512, 
+        print(f"\n--- Query ---\n{query}")
+
+        raw_json_output = generate_response(
+            model,
+            tokenizer,
+            query,
+            prompt_mode=prompt_mode,
+            template=template,
+            max_new_tokens=512,
             do_sample=True,
             temperature=0.7,
             top_k=50,
             top_p=0.95,
-            eos_token_id=stop_token_ids,
-            pad_token_id=tokenizer.pad_token_id,
         )
 
-        generated_text = outputs[0]['generated_text']
-        assistant_response_start = generated_text.find("### Assistant:") + len("### Assistant:")
-        raw_json_output = generated_text[assistant_response_start:].strip()
+        print(f"\n--- Raw Generated Response ---\n{raw_json_output}")
 
-        print(f"\\n--- Raw Generated Response ---\\n{raw_json_output}")
-
-        try:
-            parsed_json = json.loads(raw_json_output)
-            print("\\n--- Parsed JSON Output (Success) ---")
-            print(json.dumps(parsed_json, indent=2))
-        except json.JSONDecodeError as e:
-            print(f"\\n--- JSON Parsing Failed: {e} ---")
+        parsed_json, errors, repaired = parse_output(raw_json_output)
+        if parsed_json is None:
+            print("\n--- JSON Parsing Failed ---")
             print("The model did not generate valid JSON.")
+            continue
+        print(f"\n--- Parsed JSON Output ({'Repaired' if repaired else 'Success'}) ---")
+        print(json.dumps(parsed_json, indent=2))
+        for error in errors:
+            print(f"Schema violation: {error}")
 
 if __name__ == "__main__":
     main()
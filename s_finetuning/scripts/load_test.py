@@ -0,0 +1,294 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from train_new import load_config
+from inteference import load_inference_model, load_prompt_mode, stream_response
+from prompt_template import compile_prompt_template, request_values
+from router_schema import parse_output
+from tiny_model import ensure_tiny_model
+from cpu_inference import configure_cpu_threads, load_cpu_model
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a query trace against the router and measure latency")
+    parser.add_argument("--trace", default=None,
+                        help="training_data.json style JSON list or a JSONL log with a 'query' field "
+                             "(default: dataset_config.data_file)")
+    parser.add_argument("--tiny", action="store_true", help="Use the in-process tiny-model stand-in")
+    parser.add_argument("--model_id", default=None, help="Override model_id from the config")
+    parser.add_argument("--adapter_dir", default=None, help="LoRA adapters to load (default: output_dir, skipped with --tiny)")
+    parser.add_argument("--cpu_int8", action="store_true", help="Serve from the CPU inference path (merged adapters, dynamic int8)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--qps", type=float, default=None, help="Open loop: send requests at this rate")
+    mode.add_argument("--concurrency", type=int, default=None, help="Closed loop: keep this many requests in flight")
+    mode.add_argument("--replay_timestamps", action="store_true",
+                      help="Open loop: use the trace's 'timestamp' field (seconds) as arrival times")
+    parser.add_argument("--arrivals", choices=["poisson", "uniform"], default="poisson", help="Inter-arrival pattern for --qps")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Compress trace time by this factor with --replay_timestamps")
+    parser.add_argument("--max_in_flight", type=int, default=64, help="Worker threads for open-loop modes")
+    parser.add_argument("--num_requests", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=2, help="Requests sent (and discarded) before measuring")
+    parser.add_argument("--timeout", type=float, default=None, help="Count requests slower than this (seconds) as errors")
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--check_json", action="store_true",
+                        help="Count responses that are not valid (repairable) JSON or break the router schema as errors")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the summary (and per-request records) to this JSON file")
+    parser.add_argument("--compare", default=None, help="Compare against a previous --output file")
+    return parser.parse_args()
+
+def load_trace(path):
+    """Read queries (and optional timestamps) from a JSON list or a JSONL log"""
+    with open(path, 'r') as f:
+        if path.endswith(".jsonl"):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = json.load(f)
+    trace = []
+    for record in records:
+        if isinstance(record, str):
+            record = {"query": record}
+        if record.get("query"):
+            trace.append({"query": record["query"], "timestamp": record.get("timestamp"), "user": record.get("user")})
+    return trace
+
+def cycle_trace(trace, count, replay_timestamps=False):
+    """
+    The first count requests of the trace repeated end to end. With timestamps, each
+    repeat is shifted by the trace's span plus one average gap, so arrival times keep
+    increasing across the wrap instead of jumping back to the start of the trace.
+    """
+    if not replay_timestamps:
+        return [trace[i % len(trace)] for i in range(count)]
+    if any(item["timestamp"] is None for item in trace):
+        raise ValueError("--replay_timestamps needs a 'timestamp' field on every trace record")
+    trace = sorted(trace, key=lambda item: item["timestamp"])
+    span = trace[-1]["timestamp"] - trace[0]["timestamp"]
+    period = span + (span / (len(trace) - 1) if len(trace) > 1 and span > 0 else 1.0)
+    return [dict(trace[i % len(trace)], timestamp=trace[i % len(trace)]["timestamp"] + (i // len(trace)) * period)
+            for i in range(count)]
+
+def arrival_offsets(trace, args):
+    """Seconds after the start at which each request is sent, or None for closed loop"""
+    if args.replay_timestamps:
+        timestamps = [item["timestamp"] for item in trace]
+        if any(ts is None for ts in timestamps):
+            raise ValueError("--replay_timestamps needs a 'timestamp' field on every trace record")
+        start = timestamps[0]
+        return [(ts - start) / args.speedup for ts in timestamps]
+    if args.qps:
+        if args.arrivals == "uniform":
+            return [i / args.qps for i in range(len(trace))]
+        gaps = np.random.default_rng(args.seed).exponential(1.0 / args.qps, len(trace))
+        return np.concatenate([[0.0], np.cumsum(gaps[:-1])]).tolist()
+    return None
+
+class RouterClient:
+    """Sends one query through the in-process inference path and times it"""
+
+    def __init__(self, model, tokenizer, max_new_tokens, check_json=False, timeout=None, prompt_mode="full"):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.template = compile_prompt_template(tokenizer, prompt_mode)
+        self.max_new_tokens = max_new_tokens
+        self.check_json = check_json
+        self.timeout = timeout
+
+    def request(self, query, scheduled_at=None, user=None):
+        """
+        Latency is measured from the scheduled arrival time when there is one, so queueing
+        behind a saturated server shows up in the numbers instead of being hidden.
+        """
+        sent_at = time.perf_counter()
+        start = scheduled_at if scheduled_at is not None else sent_at
+        record = {"queue_delay": sent_at - start, "ttft": None, "output_tokens": 0, "error": None}
+        chunks = []
+        try:
+            prompt = self.template.encode(request_values(query, user))
+            for chunk in stream_response(self.model, self.tokenizer, prompt,
+                                         max_new_tokens=self.max_new_tokens, do_sample=False):
+                if record["ttft"] is None:
+                    record["ttft"] = time.perf_counter() - start
+                chunks.append(chunk)
+        except Exception as e:
+            record["error"] = type(e).__name__
+        record["latency"] = time.perf_counter() - start
+
+        text = "".join(chunks).strip()
+        record["output_tokens"] = len(self.tokenizer(text, add_special_tokens=False)["input_ids"]) if text else 0
+        if record["error"] is None and self.timeout and record["latency"] > self.timeout:
+            record["error"] = "timeout"
+        if record["error"] is None and self.check_json:
+            # Responses the server would repair count as successes
+            label, errors, _ = parse_output(text)
+            if label is None:
+                record["error"] = "invalid_json"
+            elif errors:
+                record["error"] = "schema_error"
+        return record
+
+def run_open_loop(client, trace, offsets, max_in_flight):
+    records = [None] * len(trace)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        start = time.perf_counter()
+        futures = []
+        for i, (item, offset) in enumerate(zip(trace, offsets)):
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append((i, pool.submit(client.request, item["query"], start + offset, item["user"])))
+        for i, future in futures:
+            records[i] = future.result()
+    return records, time.perf_counter() - start
+
+def run_closed_loop(client, trace, concurrency):
+    records = [None] * len(trace)
+    next_index = iter(range(len(trace)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                return
+            records[i] = client.request(trace[i]["query"], user=trace[i]["user"])
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, time.perf_counter() - start
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = np.asarray(values) * 1000
+    return {
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+def summarize(records, wall_time):
+    ok = [r for r in records if r["error"] is None]
+    errors = {}
+    for r in records:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "requests": len(records),
+        "errors": errors,
+        "error_rate": (len(records) - len(ok)) / max(len(records), 1),
+        "wall_time_s": wall_time,
+        "achieved_qps": len(records) / wall_time if wall_time else 0.0,
+        "output_tokens_per_s": sum(r["output_tokens"] for r in records) / wall_time if wall_time else 0.0,
+        # Slow or malformed responses still cost their full latency, so only failed requests are excluded
+        "latency": percentiles([r["latency"] for r in records if r["ttft"] is not None]),
+        "ttft": percentiles([r["ttft"] for r in records if r["ttft"] is not None]),
+        "queue_delay": percentiles([r["queue_delay"] for r in records]),
+    }
+
+def print_summary(summary, baseline=None):
+    print(f"\n📊 {summary['requests']} requests in {summary['wall_time_s']:.2f}s "
+          f"({summary['achieved_qps']:.2f} req/s, {summary['output_tokens_per_s']:.1f} output tok/s)")
+    print(f"❗ Error rate: {summary['error_rate']:.2%} {summary['errors'] or ''}")
+    if baseline:
+        print(f"   Baseline error rate: {baseline['error_rate']:.2%}, achieved QPS: {baseline['achieved_qps']:.2f}")
+
+    print(f"\n{'Metric':<14}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}" + (f"{'p99 Δ':>10}" if baseline else ""))
+    print("─" * (64 + (10 if baseline else 0)))
+    for metric in ["latency", "ttft", "queue_delay"]:
+        stats = summary[metric]
+        if not stats:
+            continue
+        row = f"{metric:<14}" + "".join(f"{stats[k]:>10.1f}" for k in ["mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"])
+        base = (baseline or {}).get(metric, {}).get("p99_ms")
+        if base:
+            row += f"{100 * (stats['p99_ms'] - base) / base:>+9.1f}%"
+        print(row)
+    print("(milliseconds)")
+
+def main():
+    args = parse_args()
+    config = load_config()
+    if config is None:
+        return
+
+    trace_path = args.trace or os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"])
+    trace = load_trace(trace_path)
+    if not trace:
+        print(f"❌ No queries found in {trace_path}")
+        return
+    if not args.replay_timestamps:
+        random.Random(args.seed).shuffle(trace)
+    # Cycle the trace when more requests are asked for than it holds
+    trace = cycle_trace(trace, args.num_requests + args.warmup, args.replay_timestamps)
+
+    if args.tiny:
+        model_id = ensure_tiny_model(data_path=os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"]))
+        adapter_dir = args.adapter_dir
+        torch_dtype = torch.float32
+    else:
+        model_id = args.model_id or config["model_id"]
+        adapter_dir = args.adapter_dir or os.path.join(os.path.dirname(__file__), '..', config["output_dir"])
+        torch_dtype = None
+    if args.cpu_int8:
+        configure_cpu_threads()
+        model, tokenizer = load_cpu_model(model_id, adapter_dir)
+    else:
+        model, tokenizer = load_inference_model(model_id, adapter_dir, torch_dtype=torch_dtype)
+    prompt_mode = load_prompt_mode(adapter_dir)
+    client = RouterClient(model, tokenizer, args.max_new_tokens, args.check_json, args.timeout, prompt_mode)
+
+    mode = (f"open loop at {args.qps} QPS ({args.arrivals})" if args.qps
+            else "trace timestamps" if args.replay_timestamps
+            else f"closed loop, concurrency {args.concurrency or 1}")
+    print(f"🚦 LOAD TEST: {args.num_requests} requests from {trace_path}, {mode}")
+    print(f"----------------------------")
+
+    for item in trace[:args.warmup]:
+        client.request(item["query"], user=item["user"])
+    trace = trace[args.warmup:]
+
+    offsets = arrival_offsets(trace, args)
+    if offsets is None:
+        records, wall_time = run_closed_loop(client, trace, args.concurrency or 1)
+    else:
+        records, wall_time = run_open_loop(client, trace, offsets, args.max_in_flight)
+    summary = summarize(records, wall_time)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)["summary"]
+    print_summary(summary, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "summary": summary,
+                "settings": {
+                    "model_id": model_id,
+                    "adapter_dir": adapter_dir,
+                    "trace": trace_path,
+                    "mode": mode,
+                    "prompt_mode": prompt_mode,
+                    "max_new_tokens": args.max_new_tokens,
+                    "torch_threads": torch.get_num_threads(),
+                },
+                "requests": records,
+            }, f, indent=2)
+        print(f"📁 Load test results saved to: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import resource
+import torch
+from transformers import AutoConfig
+from train_new import load_config
+
+# Hugging Face token for accessing gated models
+HF_TOKEN = os.environ.get("HF_TOKEN", "")
+
+GIB = 1024 ** 3
+
+# Optimizer state bytes per trainable parameter
+OPTIMIZER_STATE_BYTES = {
+    "adamw_torch": 8,
+    "adamw_torch_fused": 8,
+    "adamw_hf": 8,
+    "paged_adamw_32bit": 8,
+    "adamw_bnb_8bit": 2,
+    "adamw_8bit": 2,
+    "paged_adamw_8bit": 2,
+    "adafactor": 4,
+    "sgd": 0,
+}
+
+# CUDA context, cuBLAS workspaces and allocator fragmentation
+FIXED_OVERHEAD_BYTES = int(0.75 * GIB)
+FRAGMENTATION = 1.10
+
+# Relative cost of recomputing the forward pass with gradient checkpointing
+CHECKPOINTING_COMPUTE = 1.33
+
+# Tokens per micro-batch at which a GPU is ~50% utilized (throughput heuristic)
+HALF_SATURATION_TOKENS = 1024
+
+def text_and_vision_configs(model_config):
+    """Gemma 3 checkpoints are multimodal; the text decoder lives in text_config"""
+    text_config = getattr(model_config, "text_config", None) or model_config
+    return text_config, getattr(model_config, "vision_config", None)
+
+def linear_shapes(text_config, vision_config=None):
+    """(in_features, out_features) of every nn.Linear that LoRA 'all-linear' targets"""
+    h = text_config.hidden_size
+    i = text_config.intermediate_size
+    head_dim = getattr(text_config, "head_dim", None) or h // text_config.num_attention_heads
+    q = text_config.num_attention_heads * head_dim
+    kv = text_config.num_key_value_heads * head_dim
+    per_layer = [(h, q), (h, kv), (h, kv), (q, h), (h, i), (h, i), (i, h)]
+    shapes = per_layer * text_config.num_hidden_layers
+
+    if vision_config is not None:
+        vh, vi = vision_config.hidden_size, vision_config.intermediate_size
+        shapes += [(vh, vh)] * 4 * vision_config.num_hidden_layers
+        shapes += [(vh, vi), (vi, vh)] * vision_config.num_hidden_layers
+    return shapes
+
+def weight_bytes_per_param(quantization_args, compute_bytes):
+    """Storage per quantized linear weight, including block-wise absmax constants"""
+    if quantization_args.get("load_in_4bit"):
+        # 4-bit values + one fp32 absmax per 64 weights, or 8-bit absmax (+ fp32 per 256 blocks) with double quant
+        absmax_bits = 8 / 64 + 32 / (64 * 256) if quantization_args.get("bnb_4bit_use_double_quant") else 32 / 64
+        return (4 + absmax_bits) / 8
+    if quantization_args.get("load_in_8bit"):
+        return 1 + 4 / 4096
+    return compute_bytes
+
+def estimate_memory(model_config, quantization_args, lora_args, batch_size, seq_length,
+                    gradient_checkpointing, optim="paged_adamw_8bit", compute_bytes=2,
+                    attn_implementation="eager", quantized=True):
+    """
+    Estimate peak training memory (bytes) for one micro-batch, broken down by component.
+    Quantized runs follow prepare_model_for_kbit_training, which upcasts every
+    non-quantized parameter (embeddings, norms) to fp32.
+    """
+    text_config, vision_config = text_and_vision_configs(model_config)
+    h = text_config.hidden_size
+    i = text_config.intermediate_size
+    num_layers = text_config.num_hidden_layers
+    num_heads = text_config.num_attention_heads
+    head_dim = getattr(text_config, "head_dim", None) or h // num_heads
+    q = num_heads * head_dim
+    kv = text_config.num_key_value_heads * head_dim
+    vocab = text_config.vocab_size
+    r = lora_args["r"]
+    tokens = batch_size * seq_length
+
+    shapes = linear_shapes(text_config, vision_config)
+    linear_params = sum(a * b for a, b in shapes)
+    other_params = vocab * h + 4 * h * num_layers
+    if vision_config is not None:
+        other_params += vision_config.hidden_size * h
+    lora_params = sum(r * (a + b) for a, b in shapes)
+
+    quantized = quantized and (quantization_args.get("load_in_4bit") or quantization_args.get("load_in_8bit"))
+    weights = linear_params * weight_bytes_per_param(quantization_args if quantized else {}, compute_bytes)
+    weights += other_params * (4 if quantized else compute_bytes)
+
+    # LoRA weights and their gradients are kept in fp32
+    lora = lora_params * 4
+    gradients = lora_params * 4
+    optimizer = lora_params * OPTIMIZER_STATE_BYTES.get(optim, 8)
+
+    # Saved activations per token per decoder layer (in elements): norms, q/k/v/o,
+    # the MLP's gate/up/activation/product, LoRA bottlenecks and dropout copies of the inputs
+    attn_elems = 2 * h + q + 2 * kv + q + h
+    mlp_elems = 2 * h + 4 * i
+    lora_elems = 7 * r + (5 * h + q + i if lora_args.get("lora_dropout", 0) > 0 else 0)
+    layer_bytes = tokens * (attn_elems + mlp_elems + lora_elems) * compute_bytes
+    if attn_implementation == "eager":
+        # Attention probabilities (batch x heads x seq x seq) are materialized
+        layer_bytes += batch_size * num_heads * seq_length * seq_length * compute_bytes * 2
+
+    if gradient_checkpointing:
+        # Only layer inputs are kept; one layer is recomputed at a time during backward
+        activations = num_layers * tokens * h * compute_bytes + layer_bytes
+    else:
+        activations = num_layers * layer_bytes
+
+    # Gradients of one layer's activations coexist with the saved ones during backward
+    backward = layer_bytes
+
+    # Logits in the compute dtype, their fp32 upcast for the loss, the saved log-softmax and the fp32 gradient
+    logits = tokens * vocab * (compute_bytes + (4 if compute_bytes < 4 else 0) + 4 + 4)
+
+    # The largest weight dequantized on the fly by bitsandbytes
+    workspace = max(a * b for a, b in shapes) * compute_bytes if quantized else 0
+
+    breakdown = {
+        "weights": weights,
+        "lora": lora,
+        "gradients": gradients,
+        "optimizer": optimizer,
+        "activations": activations,
+        "backward": backward,
+        "logits": logits,
+        "workspace": workspace,
+    }
+    breakdown["total"] = int((sum(breakdown.values()) + FIXED_OVERHEAD_BYTES) * FRAGMENTATION)
+    breakdown["trainable_params"] = lora_params
+    return breakdown
+
+def relative_throughput(batch_size, seq_length, gradient_checkpointing, r, shapes):
+    """Heuristic tokens/s relative to a fully utilized device without checkpointing"""
+    tokens = batch_size * seq_length
+    utilization = tokens / (tokens + HALF_SATURATION_TOKENS)
+    lora_overhead = sum(r * (a + b) for a, b in shapes) / sum(a * b for a, b in shapes)
+    return utilization / ((CHECKPOINTING_COMPUTE if gradient_checkpointing else 1.0) * (1 + lora_overhead))
+
+def plan(model_config, config, memory_budget_bytes, batch_sizes, seq_lengths, lora_ranks,
+         checkpointing_options, compute_bytes=2, attn_implementation="eager"):
+    """Evaluate every candidate setting and return the ones that fit, fastest first"""
+    training_args = config["training_args"]
+    text_config, vision_config = text_and_vision_configs(model_config)
+    shapes = linear_shapes(text_config, vision_config)
+
+    candidates = []
+    for batch_size, seq_length, r, gradient_checkpointing in itertools.product(
+            batch_sizes, seq_lengths, lora_ranks, checkpointing_options):
+        lora_args = dict(config["lora_args"], r=r)
+        estimate = estimate_memory(
+            model_config, config["quantization_args"], lora_args, batch_size, seq_length,
+            gradient_checkpointing, optim=training_args.get("optim", "adamw_torch"),
+            compute_bytes=compute_bytes, attn_implementation=attn_implementation,
+        )
+        if estimate["total"] > memory_budget_bytes:
+            continue
+        candidates.append({
+            "per_device_train_batch_size": batch_size,
+            "max_seq_length": seq_length,
+            "r": r,
+            "gradient_checkpointing": gradient_checkpointing,
+            "estimated_gib": estimate["total"] / GIB,
+            "relative_throughput": relative_throughput(batch_size, seq_length, gradient_checkpointing, r, shapes),
+            "breakdown": estimate,
+        })
+    # Fastest first; among (nearly) equal speeds prefer the larger LoRA rank and longer context
+    candidates.sort(key=lambda c: (round(c["relative_throughput"], 2), c["r"], c["max_seq_length"]), reverse=True)
+    return candidates
+
+def suggest_accumulation(config, candidate):
+    """Keep the tokens per optimizer step of the current config"""
+    training_args = config["training_args"]
+    current_tokens = (training_args["per_device_train_batch_size"] * training_args["gradient_accumulation_steps"]
+                      * config["dataset_config"]["max_seq_length"])
+    per_micro_batch = candidate["per_device_train_batch_size"] * candidate["max_seq_length"]
+    return max(1, round(current_tokens / per_micro_batch))
+
+def print_plan(candidates, config, top):
+    if not candidates:
+        print("❌ No candidate fits the memory budget. Lower max_seq_length or use a smaller model.")
+        return
+
+    print(f"\n{'batch':>6}{'seq':>7}{'r':>5}{'ckpt':>6}{'GiB':>8}{'rel. tput':>11}  weights/act/logits (GiB)")
+    for c in candidates[:top]:
+        b = c["breakdown"]
+        print(f"{c['per_device_train_batch_size']:>6}{c['max_seq_length']:>7}{c['r']:>5}"
+              f"{'yes' if c['gradient_checkpointing'] else 'no':>6}{c['estimated_gib']:>8.2f}"
+              f"{c['relative_throughput']:>11.3f}  "
+              f"{b['weights'] / GIB:.2f}/{b['activations'] / GIB:.2f}/{b['logits'] / GIB:.2f}")
+
+    best = candidates[0]
+    print("\n✅ Proposed settings for fine_tune_config.yaml:")
+    print("lora_args:")
+    print(f"  r: {best['r']}")
+    print("training_args:")
+    print(f"  per_device_train_batch_size: {best['per_device_train_batch_size']}")
+    print(f"  gradient_accumulation_steps: {suggest_accumulation(config, best)}")
+    print(f"  gradient_checkpointing: {str(best['gradient_checkpointing']).lower()}")
+    print("dataset_config:")
+    print(f"  max_seq_length: {best['max_seq_length']}")
+    print("batching_args:")
+    print(f"  max_tokens_per_batch: {best['per_device_train_batch_size'] * best['max_seq_length']}")
+
+def _probe_worker(model_dir, lora_args, batch_size, seq_length, gradient_checkpointing, queue):
+    """Run one forward/backward pass in a fresh process and report the peak memory it added"""
+    from transformers import AutoModelForCausalLM
+    from peft import LoraConfig, get_peft_model
+
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=torch.float32, attn_implementation="eager")
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    model = get_peft_model(model, LoraConfig(**lora_args))
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad])
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, seq_length))
+
+    if torch.cuda.is_available():
+        model.cuda()
+        input_ids = input_ids.cuda()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = 0
+    else:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    model.train()
+    loss = model(input_ids=input_ids, labels=input_ids).loss
+    loss.backward()
+    optimizer.step()
+
+    if torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        # Peak RSS only grows, so the delta bounds what training added on top of the loaded model
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    queue.put(peak)
+
+def probe(config, batch_size, seq_length, gradient_checkpointing):
+    """
+    Check the activation/logits/LoRA model against a measured run on the tiny model.
+    Weights are excluded on CPU (they are resident before the baseline is taken).
+    """
+    from tiny_model import ensure_tiny_model
+
+    raw_data_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"])
+    model_dir = ensure_tiny_model(data_path=raw_data_path)
+    model_config = AutoConfig.from_pretrained(model_dir)
+
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    worker = ctx.Process(target=_probe_worker, args=(model_dir, config["lora_args"], batch_size, seq_length,
+                                                      gradient_checkpointing, queue))
+    worker.start()
+    measured = queue.get()
+    worker.join()
+
+    estimate = estimate_memory(model_config, {}, config["lora_args"], batch_size, seq_length,
+                               gradient_checkpointing, optim="adamw_torch", compute_bytes=4,
+                               attn_implementation="eager", quantized=False)
+    on_gpu = torch.cuda.is_available()
+    keys = ["weights", "lora", "gradients", "optimizer", "activations", "backward", "logits"] if on_gpu \
+        else ["gradients", "optimizer", "activations", "backward", "logits"]
+    predicted = sum(estimate[k] for k in keys)
+    error = 100 * (predicted - measured) / measured if measured else float("nan")
+    print(f"🔬 Probe (tiny model, batch={batch_size}, seq={seq_length}, "
+          f"checkpointing={gradient_checkpointing}, {'CUDA' if on_gpu else 'CPU RSS'}): "
+          f"estimated {predicted / 2**20:.1f} MiB, measured {measured / 2**20:.1f} MiB ({error:+.1f}%)")
+    return predicted, measured
+
+def main():
+    config = load_config()
+    if config is None:
+        return
+
+    parser = argparse.ArgumentParser(description="Estimate training memory and propose the fastest settings that fit")
+    parser.add_argument("--memory_gb", type=float, default=24.0, help="Device memory budget in GiB")
+    parser.add_argument("--model_id", default=config["model_id"])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--seq_lengths", type=int, nargs="+", default=None,
+                        help="Candidate max_seq_length values (default: the configured one)")
+    parser.add_argument("--lora_ranks", type=int, nargs="+", default=None,
+                        help="Candidate LoRA ranks (default: the configured one)")
+    parser.add_argument("--attn_implementation", default="eager", choices=["eager", "sdpa", "flash_attention_2"])
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", default=None, help="Write all fitting candidates to this file")
+    parser.add_argument("--probe", action="store_true", help="Verify the estimate on the tiny model")
+    parser.add_argument("--probe_batch_size", type=int, default=2)
+    parser.add_argument("--probe_seq_length", type=int, default=512)
+    args = parser.parse_args()
+
+    if args.probe:
+        for gradient_checkpointing in (False, True):
+            probe(config, args.probe_batch_size, args.probe_seq_length, gradient_checkpointing)
+
+    model_config = AutoConfig.from_pretrained(args.model_id, token=HF_TOKEN, trust_remote_code=True)
+    compute_dtype = config["quantization_args"].get("bnb_4bit_compute_dtype", torch.bfloat16)
+    seq_lengths = args.seq_lengths or [config["dataset_config"]["max_seq_length"]]
+    lora_ranks = args.lora_ranks or [config["lora_args"]["r"]]
+
+    print(f"🧠 Planning for {args.model_id} within {args.memory_gb} GiB")
+    candidates = plan(
+        model_config, config, args.memory_gb * GIB, args.batch_sizes, seq_lengths, lora_ranks,
+        checkpointing_options=(False, True), compute_bytes=torch.empty(0, dtype=compute_dtype).element_size(),
+        attn_implementation=args.attn_implementation,
+    )
+    print_plan(candidates, config, args.top)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(candidates, f, indent=2)
+        print(f"📁 Candidates saved to: {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 import json
 import os
+import random
 import yaml
 from datetime import datetime, timedelta
 import google.generativeai as genai
-from constants import SYSTEM_PROMPT
+from constants import format_user_content
+from prompt_template import render_user_content
 from colorama import Fore, Style
-import re
+from dedup import deduplicate, print_report
+from router_schema import TIME_RANGE_VALIDATOR, parse_output, repair_json_text, schema_errors
 
 def setup_gemini_api():
     """Setup Gemini API with your API key"""
@@ -67,12 +70,9 @@ Be precise with calculations. Use 00:00:00 for start times and 23:59:59 for end
         response = gemini_model.generate_content(prompt)
         response_text = response.text.strip()
         
-        # Extract JSON from response
-        # Find JSON object in the response
-        json_match = re.search(r'\{[^}]*\}', response_text)
-        if json_match:
-            time_data = json.loads(json_match.group())
-            
+        # Extract the JSON object from the response (fences, prose and small format slips are repaired)
+        time_data, errors, _ = parse_output(response_text, TIME_RANGE_VALIDATOR)
+        if time_data is not None and not errors:
             # Update the data entry
             updated_entry = data_entry.copy()
             updated_entry["data"]["filters"]["startTime"] = time_data.get("startTime")
@@ -81,23 +81,50 @@ Be precise with calculations. Use 00:00:00 for start times and 23:59:59 for end
             print(f"{Fore.GREEN}✅ Updated time references for: {query[:50]}...{Style.RESET_ALL}")
             return updated_entry
         else:
-            print(f"{Fore.YELLOW}⚠️  No valid JSON found in Gemini response for: {query[:50]}...{Style.RESET_ALL}")
+            print(f"{Fore.YELLOW}⚠️  No valid JSON found in Gemini response for: {query[:50]}... ({'; '.join(errors)}){Style.RESET_ALL}")
             return data_entry
             
     except Exception as e:
         print(f"{Fore.RED}❌ Error processing with Gemini: {e}{Style.RESET_ALL}")
         return data_entry
 
-def format_data_for_finetuning(raw_json_data):
+def load_raw_data(raw_data_path):
+    """Load the raw training data, repairing trailing commas and similar slips if the file has them"""
+    try:
+        with open(raw_data_path, "r") as f:
+            return json.load(f)
+    except json.JSONDecodeError as e:
+        print(f"{Fore.RED}❌ JSON Error: {e}{Style.RESET_ALL}")
+        print(f"{Fore.YELLOW}🔧 Attempting to repair the JSON...{Style.RESET_ALL}")
+        
+        with open(raw_data_path, "r") as f:
+            content = f.read()
+        
+        # Try parsing the repaired content
+        raw_json_data = json.loads(repair_json_text(content))
+        print(f"{Fore.GREEN}✅ Successfully fixed and loaded data!{Style.RESET_ALL}")
+        return raw_json_data
+
+def split_eval(raw_json_data, eval_fraction, seed=42):
+    """Deterministically hold out eval_fraction of the samples; returns (train, eval)"""
+    if eval_fraction <= 0:
+        return raw_json_data, []
+    shuffled = list(raw_json_data)
+    random.Random(seed).shuffle(shuffled)
+    num_eval = max(1, int(len(shuffled) * eval_fraction))
+    return shuffled[num_eval:], shuffled[:num_eval]
+
+def format_data_for_finetuning(raw_json_data, use_gemini=True, prompt_mode="full"):
     """
     Converts a list of raw data entries into the format required for SFTTrainer.
     Each entry in the raw data should have a "query" and a "data" key.
+    prompt_mode selects the full system prompt or a short distilled form (see constants.PROMPT_MODES).
     """
     current_date = datetime.now()
     
     # Setup Gemini API
-    gemini_model = setup_gemini_api()
-    if not gemini_model:
+    gemini_model = setup_gemini_api() if use_gemini else None
+    if use_gemini and not gemini_model:
         print(f"{Fore.YELLOW}⚠️  Continuing without Gemini API - time references won't be updated{Style.RESET_ALL}")
     
     formatted_examples = []
@@ -119,7 +146,7 @@ def format_data_for_finetuning(raw_json_data):
 
         # Construct the messages list for the chat template
         messages_list = [
-            {"role": "user", "content": f"User Query: {user_query}\n\n{SYSTEM_PROMPT}"},
+            {"role": "user", "content": render_user_content(user_query, prompt_mode, now=current_date)},
             {"role": "model", "content": output_json_string}
         ]
         formatted_examples.append({"messages": messages_list})
@@ -138,30 +165,38 @@ if __name__ == "__main__":
     # Define file paths from the config
     raw_data_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"])
     processed_data_output_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["processed_data_output"])
+    prompt_mode = config["dataset_config"].get("prompt_mode", "full")
 
     print(f"Loading raw data from: {raw_data_path}")
-    
-    try:
-        with open(raw_data_path, "r") as f:
-            raw_json_data = json.load(f)
-    except json.JSONDecodeError as e:
-        print(f"{Fore.RED}❌ JSON Error: {e}{Style.RESET_ALL}")
-        print(f"{Fore.YELLOW}🔧 Attempting to fix trailing comma...{Style.RESET_ALL}")
-        
-        # Read and fix the file
-        with open(raw_data_path, "r") as f:
-            content = f.read()
-        
-        # Remove trailing commas before closing brackets/braces
-        import re
-        fixed_content = re.sub(r',(\s*[}\]])', r'\1', content)
-        
-        # Try parsing the fixed content
-        raw_json_data = json.loads(fixed_content)
-        print(f"{Fore.GREEN}✅ Successfully fixed and loaded data!{Style.RESET_ALL}")
-
-    print(f"Processing {len(raw_json_data)} samples into chat format...")
-    processed_data = format_data_for_finetuning(raw_json_data)
+    raw_json_data = load_raw_data(raw_data_path)
+
+    # Labels outside the router schema are kept, but listed so they can be fixed at the source
+    invalid_labels = [(item["query"], errors) for item in raw_json_data if (errors := schema_errors(item["data"]))]
+    if invalid_labels:
+        print(f"{Fore.YELLOW}⚠️  {len(invalid_labels)}/{len(raw_json_data)} labels do not match the router schema:{Style.RESET_ALL}")
+        for query, errors in invalid_labels[:10]:
+            print(f"{Fore.YELLOW}   {query[:50]}: {'; '.join(errors)}{Style.RESET_ALL}")
+
+    # Drop near-duplicate queries before they cost Gemini calls and training compute
+    dedup_config = config.get("dedup_config", {})
+    if dedup_config.get("enabled", False):
+        raw_json_data, dedup_report = deduplicate(raw_json_data, prompt_chars=len(format_user_content("", prompt_mode)), **dedup_config)
+        print_report(dedup_report)
+        if dedup_config.get("report_output"):
+            report_path = os.path.join(os.path.dirname(__file__), '..', dedup_config["report_output"])
+            with open(report_path, "w") as f:
+                json.dump(dedup_report, f, indent=2)
+
+    # Hold out raw samples (after dedup, so near-duplicates can't leak) for evaluate.py
+    raw_json_data, eval_data = split_eval(raw_json_data, config["dataset_config"].get("eval_fraction", 0))
+    if eval_data:
+        eval_data_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["eval_data_output"])
+        with open(eval_data_path, "w") as f:
+            json.dump(eval_data, f, indent=2, ensure_ascii=False)
+        print(f"{Fore.CYAN}🧪 Held out {len(eval_data)} samples for evaluation: {eval_data_path}{Style.RESET_ALL}")
+
+    print(f"Processing {len(raw_json_data)} samples into chat format (prompt_mode: {prompt_mode})...")
+    processed_data = format_data_for_finetuning(raw_json_data, prompt_mode=prompt_mode)
 
     print(f"Saving processed data to: {processed_data_output_path}")
     with open(processed_data_output_path, "w") as f:
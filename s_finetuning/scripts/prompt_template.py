@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import re
+import time
+from datetime import datetime
+from functools import lru_cache
+from transformers import AutoTokenizer
+from constants import format_user_content, GEMMA_CHAT_TEMPLATE
+from tiny_model import ensure_tiny_model
+
+# Per-request slots. [PROMPT_DATE] is the date in the prompt's first line; the rest
+# already appear literally in SYSTEM_PROMPT and were never filled in before.
+QUERY_PLACEHOLDER = "[USER_QUERY]"
+PROMPT_DATE_PLACEHOLDER = "[PROMPT_DATE]"
+USER_PLACEHOLDERS = {
+    "name": "[NAME_OF_THE_USER]",
+    "email": "[EMAIL_OF_THE_USER]",
+    "company": "[COMPANY_NAME]",
+    "company_domain": "[COMPANY_DOMAIN]",
+}
+TIME_PLACEHOLDERS = ["[CURRENT_TIME]", "[CURRENT_DATE]"]
+PLACEHOLDERS = [QUERY_PLACEHOLDER, PROMPT_DATE_PLACEHOLDER, *USER_PLACEHOLDERS.values(), *TIME_PLACEHOLDERS]
+
+def request_values(query, user=None, now=None):
+    """
+    Placeholder values for one request asked at `now` (default: the current time).
+    The date and time are always filled, as in training. User fields that are not
+    given keep their placeholder text; the training data has no users, so the model
+    only ever saw the placeholders there.
+    """
+    now = now or datetime.now()
+    values = {
+        QUERY_PLACEHOLDER: query,
+        PROMPT_DATE_PLACEHOLDER: now.strftime("%d %B %Y"),
+        "[CURRENT_TIME]": now.strftime("%H:%M"),
+        "[CURRENT_DATE]": now.strftime("%A, %d %B %Y"),
+    }
+    for field, placeholder in USER_PLACEHOLDERS.items():
+        if user and user.get(field):
+            values[placeholder] = user[field]
+    return values
+
+def render_user_content(query, prompt_mode="full", user=None, now=None):
+    """User turn content with the prompt date, time and (given) user fields filled in"""
+    values = request_values(query, user, now)
+    content = format_user_content(query, prompt_mode, current_date=values[PROMPT_DATE_PLACEHOLDER])
+    for placeholder in [*USER_PLACEHOLDERS.values(), *TIME_PLACEHOLDERS]:
+        content = content.replace(placeholder, values.get(placeholder, placeholder))
+    return content
+
+class PromptTemplate:
+    """
+    A prompt split into static text and placeholder slots. Static segments are tokenized
+    once at compile time; slot values are tokenized per request (with a small cache, since
+    dates, times and users repeat) and the ids are concatenated.
+
+    Spaces in front of a slot are moved into the slot so "Email: x" tokenizes as
+    "Email:" + " x", as it does in context. Segment-wise tokenization only matches
+    tokenizing the whole string if the tokenizer never merges across a segment
+    boundary, so the template checks this once against sample values and falls back to
+    whole-string tokenization (with a warning) when it does not hold.
+    """
+
+    def __init__(self, text, tokenizer, placeholders=PLACEHOLDERS, value_cache_size=4096):
+        self.tokenizer = tokenizer
+        self.segments = []  # (static text, static ids, None) or (leading spaces, None, placeholder)
+        pattern = re.compile("|".join(re.escape(p) for p in placeholders))
+        position = 0
+        for match in pattern.finditer(text):
+            leading_spaces = self._add_static(text[position:match.start()])
+            self.segments.append((leading_spaces, None, match.group()))
+            position = match.end()
+        self._add_static(text[position:])
+
+        self._encode_value = lru_cache(maxsize=value_cache_size)(self._tokenize)
+        self.segment_exact = True
+        self.segment_exact = self.verify(request_values("Find emails from bob@example.com about the Q3 budget", {
+            "name": "Jane Doe", "email": "jane@example.com", "company": "Example Corp", "company_domain": "example.com",
+        }))
+        if not self.segment_exact:
+            print("⚠️  Tokenizer merges across prompt segment boundaries; falling back to whole-prompt tokenization")
+
+    def _add_static(self, text):
+        """Append a static segment and return its trailing spaces, which belong to the next slot"""
+        stripped = text.rstrip(" ")
+        if stripped:
+            self.segments.append((stripped, self._tokenize(stripped), None))
+        return text[len(stripped):]
+
+    def _tokenize(self, text):
+        return tuple(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    @property
+    def static_tokens(self):
+        return sum(len(ids) for _, ids, slot in self.segments if slot is None)
+
+    def render(self, values):
+        """Plain-text prompt, for logging and for tokenizers that need the whole string"""
+        return "".join(text + values.get(slot, slot) if slot else text for text, _, slot in self.segments)
+
+    def encode(self, values):
+        """Prompt token ids assembled from cached segments"""
+        if not self.segment_exact:
+            return list(self._tokenize(self.render(values)))
+        ids = []
+        for text, static_ids, slot in self.segments:
+            ids.extend(static_ids if slot is None else self._encode_value(text + values.get(slot, slot)))
+        return ids
+
+    def verify(self, values):
+        """True if segment-wise encoding matches tokenizing the rendered prompt"""
+        return self.encode(values) == list(self._tokenize(self.render(values)))
+
+def compile_prompt_template(tokenizer, prompt_mode="full"):
+    """Chat-formatted user turn plus generation marker, with the query, date, time and user as slots"""
+    content = format_user_content(QUERY_PLACEHOLDER, prompt_mode, current_date=PROMPT_DATE_PLACEHOLDER)
+    text = tokenizer.apply_chat_template([{"role": "user", "content": content}], tokenize=False, add_generation_prompt=True)
+    return PromptTemplate(text, tokenizer)
+
+def benchmark(tokenizer, prompt_mode, queries, repeats):
+    """Compare rebuilding + tokenizing the prompt string per request against template assembly"""
+    from inteference import build_prompt  # inteference imports this module
+
+    start_time = time.perf_counter()
+    template = compile_prompt_template(tokenizer, prompt_mode)
+    compile_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        for query in queries:
+            tokenizer(build_prompt(tokenizer, query, prompt_mode), add_special_tokens=False)
+    string_time = (time.perf_counter() - start_time) / (repeats * len(queries))
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        for query in queries:
+            template.encode(request_values(query))
+    template_time = (time.perf_counter() - start_time) / (repeats * len(queries))
+
+    mismatches = sum(not template.verify(request_values(query)) for query in queries)
+    print(f"\n📐 prompt_mode: {prompt_mode}")
+    print(f"   Static tokens cached: {template.static_tokens}, segments: {len(template.segments)}, compile: {compile_time * 1000:.1f} ms")
+    print(f"   String rebuild + tokenize: {string_time * 1000:.3f} ms/request")
+    print(f"   Template assembly:         {template_time * 1000:.3f} ms/request ({string_time / template_time:.1f}x faster)")
+    print(f"   Segment-exact: {template.segment_exact}, mismatching queries: {mismatches}/{len(queries)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark and check the segment-cached prompt template")
+    parser.add_argument("--tokenizer", default=None, help="Tokenizer to use (default: the local tiny model)")
+    parser.add_argument("--prompt_modes", nargs="+", default=["full", "compressed", "tag"])
+    parser.add_argument("--num_queries", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    raw_data_path = os.path.join(os.path.dirname(__file__), '../training_data.json')
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer or ensure_tiny_model(data_path=raw_data_path))
+    tokenizer.chat_template = GEMMA_CHAT_TEMPLATE
+    with open(raw_data_path, 'r') as f:
+        queries = [item["query"] for item in json.load(f)][:args.num_queries]
+
+    for prompt_mode in args.prompt_modes:
+        benchmark(tokenizer, prompt_mode, queries, args.repeats)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,528 @@
+import argparse
+import copy
+import json
+import os
+import random
+import re
+import time
+
+try:
+    import jsonschema
+except ImportError:  # Only needed for the benchmark
+    jsonschema = None
+
+# Values allowed by the output spec in SYSTEM_PROMPT, plus the Drive entities "form" and
+# "csv" that training_data.json also uses
+ROUTER_TYPES = ["SearchWithoutFilters", "SearchWithFilters", "GetItems"]
+APP_ENTITIES = {
+    "gmail": ["mail", "pdf", "sheets", "csv", "word_document", "powerpoint_presentation", "text", "not_valid"],
+    "google-drive": ["docs", "sheets", "slides", "pdf", "folder", "form", "csv"],
+    "google-calendar": ["event"],
+    "google-workspace": ["Contacts", "OtherContacts"],
+    "slack": ["message"],
+}
+INTENT_FIELDS = ["from", "to", "cc", "bcc", "subject"]
+# YYYY-MM-DDTHH:mm:ss, optionally with milliseconds and a UTC offset (YYYY-MM-DDTHH:mm:ss.SSS+05:30)
+DATETIME_PATTERN = r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{3})?([+-]\d{2}:\d{2}|Z)?$"
+
+NULLABLE_STRING = {"type": ["string", "null"]}
+NULLABLE_DATETIME = {"type": ["string", "null"], "pattern": DATETIME_PATTERN}
+
+ROUTER_JSON_SCHEMA = {
+    "type": "object",
+    "required": ["answer", "queryRewrite", "temporalDirection", "isFollowUp", "type", "filterQuery", "filters"],
+    "additionalProperties": False,
+    "properties": {
+        "answer": NULLABLE_STRING,
+        "queryRewrite": NULLABLE_STRING,
+        "temporalDirection": {"enum": ["next", "prev", None]},
+        "isFollowUp": {"type": "boolean"},
+        "type": {"enum": ROUTER_TYPES},
+        "filterQuery": NULLABLE_STRING,
+        "filters": {
+            "type": "object",
+            "required": ["app", "entity", "count", "startTime", "endTime", "sortDirection", "intent"],
+            "additionalProperties": False,
+            "properties": {
+                "app": {"enum": [*APP_ENTITIES, None]},
+                "entity": {"type": ["string", "null"]},
+                "count": {"type": ["integer", "null"], "minimum": 1},
+                "startTime": NULLABLE_DATETIME,
+                "endTime": NULLABLE_DATETIME,
+                "sortDirection": {"enum": ["asc", "desc", None]},
+                "intent": {
+                    "type": "object",
+                    "additionalProperties": False,
+                    "properties": {field: {"type": "array", "items": {"type": "string"}} for field in INTENT_FIELDS},
+                },
+            },
+            # The entity must belong to the app; without an app any known entity is allowed
+            "allOf": [
+                {
+                    "if": {"properties": {"app": {"const": app}}, "required": ["app"]},
+                    "then": {"properties": {"entity": {"enum": [*entities, None]}}},
+                }
+                for app, entities in [
+                    *APP_ENTITIES.items(),
+                    (None, sorted({entity for entities in APP_ENTITIES.values() for entity in entities})),
+                ]
+            ],
+        },
+    },
+}
+
+# Gemini's answer in prepare_data.update_time_references_with_gemini
+TIME_RANGE_SCHEMA = {
+    "type": "object",
+    "required": ["startTime", "endTime"],
+    "properties": {"startTime": NULLABLE_DATETIME, "endTime": NULLABLE_DATETIME},
+}
+
+JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "null": type(None),
+}
+SUPPORTED_KEYWORDS = {"type", "enum", "const", "pattern", "minimum", "properties", "required",
+                      "additionalProperties", "items", "allOf", "if", "then"}
+
+def compile_schema(schema, path="$"):
+    """
+    Compile the JSON Schema subset used here into a checker: check(value, errors) appends
+    "path: message" strings for every violation and returns True if there were none.
+    Everything is resolved once: types become isinstance tuples, enums become sets,
+    patterns are precompiled, and each property gets its own checker with its path fixed
+    (array items are reported as "path[]"), so validation is a chain of plain Python calls.
+    Unsupported keywords raise at compile time instead of being silently ignored.
+    """
+    unsupported = set(schema) - SUPPORTED_KEYWORDS
+    if unsupported:
+        raise ValueError(f"Unsupported schema keywords: {sorted(unsupported)}")
+    checks = []
+
+    type_check = None
+    if "type" in schema:
+        names = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        python_types = tuple(t for name in names for t in (JSON_TYPES[name] if isinstance(JSON_TYPES[name], tuple) else (JSON_TYPES[name],)))
+        # bool is an int subclass, but JSON booleans are not numbers
+        reject_bool = "boolean" not in names
+        expected = " or ".join(names)
+
+        def type_check(value, errors):
+            if not isinstance(value, python_types) or (reject_bool and isinstance(value, bool)):
+                errors.append(f"{path}: expected {expected}, got {json.dumps(value)[:40]}")
+                return False
+            return True
+
+    if "enum" in schema or "const" in schema:
+        allowed = schema["enum"] if "enum" in schema else [schema["const"]]
+        # 1 == True, so booleans are kept apart from the hashed values
+        hashable = {value for value in allowed if not isinstance(value, bool)}
+        booleans = [value for value in allowed if isinstance(value, bool)]
+
+        def check_enum(value, errors):
+            if isinstance(value, bool):
+                ok = value in booleans
+            else:
+                try:
+                    ok = value in hashable
+                except TypeError:
+                    ok = False
+            if not ok:
+                errors.append(f"{path}: {json.dumps(value)[:40]} is not one of {allowed}")
+            return ok
+        checks.append(check_enum)
+
+    if "pattern" in schema:
+        pattern = re.compile(schema["pattern"])
+
+        def check_pattern(value, errors):
+            if isinstance(value, str) and not pattern.search(value):
+                errors.append(f"{path}: {value!r} does not match {schema['pattern']}")
+                return False
+            return True
+        checks.append(check_pattern)
+
+    if "minimum" in schema:
+        minimum = schema["minimum"]
+
+        def check_minimum(value, errors):
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value < minimum:
+                errors.append(f"{path}: {value} is less than {minimum}")
+                return False
+            return True
+        checks.append(check_minimum)
+
+    if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+        prefix = "" if path == "$" else f"{path}."
+        property_checks = {name: compile_schema(sub, prefix + name) for name, sub in schema.get("properties", {}).items()}
+        required = schema.get("required", [])
+        allow_additional = schema.get("additionalProperties", True)
+        if allow_additional not in (True, False):
+            raise ValueError("additionalProperties must be true or false")
+
+        def check_object(value, errors):
+            if not isinstance(value, dict):
+                return True
+            count = len(errors)
+            for name in required:
+                if name not in value:
+                    errors.append(f"{prefix}{name}: missing")
+            if allow_additional:
+                for name, property_check in property_checks.items():
+                    if name in value:
+                        property_check(value[name], errors)
+            else:
+                for name, item in value.items():
+                    property_check = property_checks.get(name)
+                    if property_check is not None:
+                        property_check(item, errors)
+                    else:
+                        errors.append(f"{prefix}{name}: unexpected field")
+            return len(errors) == count
+        checks.append(check_object)
+
+    if "items" in schema:
+        item_check = compile_schema(schema["items"], f"{path}[]")
+
+        def check_items(value, errors):
+            if not isinstance(value, list):
+                return True
+            count = len(errors)
+            for item in value:
+                item_check(item, errors)
+            return len(errors) == count
+        checks.append(check_items)
+
+    if "if" in schema:
+        condition = compile_schema(schema["if"], path)
+        consequence = compile_schema(schema.get("then", {}), path)
+
+        def check_if_then(value, errors):
+            if condition(value, []):
+                return consequence(value, errors)
+            return True
+        checks.append(check_if_then)
+
+    branches, others = _split_const_branches(schema.get("allOf", []))
+    for sub_schema in others:
+        checks.append(compile_schema(sub_schema, path))
+    if branches:
+        # "if key == c then ..." branches on one key become a single dict lookup
+        key = branches[0][0]
+        dispatch = {(isinstance(const, bool), const): compile_schema(then, path) for _, const, then in branches}
+
+        def check_branches(value, errors):
+            if not isinstance(value, dict) or key not in value:
+                return True
+            branch_value = value[key]
+            try:
+                branch = dispatch.get((isinstance(branch_value, bool), branch_value))
+            except TypeError:
+                return True
+            return branch is None or branch(value, errors)
+        checks.append(check_branches)
+
+    if type_check is None and len(checks) == 1:
+        return checks[0]
+
+    def check(value, errors):
+        # Nothing else is meaningful for a value of the wrong type
+        if type_check is not None and not type_check(value, errors):
+            return False
+        ok = True
+        for single_check in checks:
+            ok = single_check(value, errors) and ok
+        return ok
+    return check
+
+def _split_const_branches(sub_schemas):
+    """Split allOf entries into if/then branches on a const value of one shared key, and the rest"""
+    branches, others = [], []
+    for sub_schema in sub_schemas:
+        condition = sub_schema.get("if", {})
+        properties = condition.get("properties", {})
+        if (set(sub_schema) == {"if", "then"} and set(condition) == {"properties", "required"}
+                and len(properties) == 1 and condition["required"] == list(properties)
+                and set(next(iter(properties.values()))) == {"const"}):
+            key, const_schema = next(iter(properties.items()))
+            branches.append((key, const_schema["const"], sub_schema["then"]))
+        else:
+            others.append(sub_schema)
+    if len({key for key, _, _ in branches}) > 1:
+        return [], sub_schemas
+    return branches, others
+
+ROUTER_VALIDATOR = compile_schema(ROUTER_JSON_SCHEMA)
+TIME_RANGE_VALIDATOR = compile_schema(TIME_RANGE_SCHEMA)
+
+def schema_errors(data, validator=ROUTER_VALIDATOR):
+    """List of schema violations (empty if data is valid)"""
+    errors = []
+    validator(data, errors)
+    return errors
+
+PYTHON_LITERALS = {"None": "null", "True": "true", "False": "false"}
+
+def repair_json_text(text):
+    """
+    Best-effort fix of common malformed JSON from LLMs: markdown fences and prose around
+    the value, trailing commas, Python None/True/False, and output cut off by the token
+    limit (open strings and brackets are closed). Returns the text of the first JSON
+    object or array in text.
+    """
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return text
+    out, stack = [], []
+    in_string = escaped = False
+    i = start
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            out.append(char)
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+            out.append(char)
+        elif char in "}]":
+            _drop_trailing_comma(out)
+            out.append(char)
+            if stack:
+                stack.pop()
+            if not stack:
+                return "".join(out)
+        elif char.isalpha():
+            # Same character class as the guard, so non-ASCII letters are consumed too
+            end = i + 1
+            while end < len(text) and text[end].isalpha():
+                end += 1
+            word = text[i:end]
+            out.append(PYTHON_LITERALS.get(word, word))
+            i += len(word)
+            continue
+        else:
+            out.append(char)
+        i += 1
+
+    # Truncated: close the open string, complete a dangling key/value separator, close brackets
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ":":
+        out.append(" null")
+    _drop_trailing_comma(out)
+    out.extend(reversed(stack))
+    return "".join(out)
+
+def _drop_trailing_comma(out):
+    j = len(out) - 1
+    while j >= 0 and out[j].isspace():
+        j -= 1
+    if j >= 0 and out[j] == ",":
+        del out[j]
+
+DATE_ONLY = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+SPACE_SEPARATED_DATETIME = re.compile(r"^(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2}.*)$")
+LOWERCASE_FIELDS = {"temporalDirection", "sortDirection", "app"}
+NULLABLE_FIELDS = {"answer", "queryRewrite", "temporalDirection", "filterQuery", "app", "entity",
+                   "count", "startTime", "endTime", "sortDirection"}
+
+def repair_values(data):
+    """
+    Fix values that are right in substance but wrong in form, in place: "null" strings,
+    numeric strings for count, capitalized enum values, dates without a time. Returns
+    True if anything changed.
+    """
+    changed = False
+    for container in (data, data.get("filters")):
+        if not isinstance(container, dict):
+            continue
+        for key, value in list(container.items()):
+            new_value = value
+            if isinstance(value, str):
+                if key in NULLABLE_FIELDS and value.strip().lower() in ("null", "none", ""):
+                    new_value = None
+                elif key in LOWERCASE_FIELDS:
+                    new_value = value.strip().lower()
+                elif key == "count" and value.strip().isdigit():
+                    new_value = int(value)
+                elif key in ("startTime", "endTime"):
+                    if DATE_ONLY.match(value):
+                        new_value = value + ("T00:00:00" if key == "startTime" else "T23:59:59")
+                    else:
+                        new_value = SPACE_SEPARATED_DATETIME.sub(r"\1T\2", value)
+            elif key == "intent" and value is None:
+                new_value = {}
+            if new_value != value:
+                container[key] = new_value
+                changed = True
+    return changed
+
+def parse_output(text, validator=ROUTER_VALIDATOR, repair=True):
+    """
+    Parse and validate one model output. Returns (data, errors, repaired): data is None if
+    no JSON object could be recovered, errors lists schema violations, repaired tells
+    whether the strict parse failed or values had to be fixed.
+    """
+    data, repaired = None, False
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        if repair and text:
+            try:
+                data = json.loads(repair_json_text(text))
+                repaired = True
+            except json.JSONDecodeError:
+                pass
+    if not isinstance(data, dict):
+        return None, ["$: no JSON object found"], repaired
+    return _validate(data, validator, repair, repaired)
+
+def _validate(data, validator, repair, repaired):
+    errors = []
+    if not validator(data, errors) and repair and repair_values(data):
+        repaired = True
+        errors = []
+        validator(data, errors)
+    return data, errors, repaired
+
+def validate_batch(texts, validator=ROUTER_VALIDATOR, repair=True):
+    """
+    parse_output for a batch. Every output is parsed on its own: one json.loads over the
+    joined batch is faster, but a truncated output followed by one that starts mid-object
+    parses as a single object and shifts the results onto the wrong outputs.
+    """
+    return [parse_output(text, validator, repair) for text in texts]
+
+# Hand-written repair inputs and the object each should parse to (None: unrepairable)
+REPAIR_CASES = [
+    ('```json\n{"a": 1}\n```', {"a": 1}),
+    ('{"a": [1, 2,],}', {"a": [1, 2]}),
+    ('{"a": None, "b": True}', {"a": None, "b": True}),
+    ('{"a": "tru', {"a": "tru"}),
+    ('{"a": ', {"a": None}),
+    ('{"a": ñ}', None),
+    ('{"a": Über}', None),
+]
+# Batches whose outputs only parse correctly one at a time, with the object each yields
+BATCH_CASES = [
+    (['{"a":1', '"b":2}', '{"c":3},{"d":4}'], [{"a": 1}, None, {"c": 3}]),
+]
+
+def corrupt_output(data, rng):
+    """One malformed variant of a valid router JSON, as models tend to produce"""
+    text = json.dumps(data, separators=(',', ':'))
+    corruption = rng.choice(["fence", "prose", "trailing_comma", "python", "truncate", "bad_app", "count_string", "date_only"])
+    if corruption == "fence":
+        return f"```json\n{json.dumps(data, indent=2)}\n```"
+    if corruption == "prose":
+        return f"Here is the routing JSON: {text} Let me know if you need anything else."
+    if corruption == "trailing_comma":
+        return text[:-2] + ",}}" if text.endswith("}}") else text[:-1] + ",}"
+    if corruption == "python":
+        return text.replace("null", "None").replace("true", "True").replace("false", "False")
+    if corruption == "truncate":
+        return text[:int(len(text) * rng.uniform(0.6, 0.95))]
+    broken = copy.deepcopy(data)
+    if corruption == "bad_app":
+        broken["filters"]["app"] = "outlook"
+    elif corruption == "count_string":
+        broken["filters"]["count"] = "5"
+    else:
+        broken["filters"]["startTime"] = "2024-10-01"
+    return json.dumps(broken)
+
+def benchmark(labels, repeats):
+    """Time the compiled checks against per-item json.loads and a generic jsonschema validator"""
+    texts = [json.dumps(label, separators=(',', ':')) for label in labels]
+
+    def timed(fn):
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (time.perf_counter() - start_time) / (repeats * len(texts)) * 1e6
+
+    timings = {
+        "compiled": timed(lambda: [parse_output(text) for text in texts]),
+    }
+    if jsonschema is not None:
+        generic = jsonschema.Draft7Validator(ROUTER_JSON_SCHEMA)
+        timings["jsonschema Draft7"] = timed(lambda: [list(generic.iter_errors(json.loads(text))) for text in texts])
+
+    print(f"\n⏱️  Validation of {len(texts)} router outputs")
+    for name, microseconds in timings.items():
+        print(f"   {name:<22} {microseconds:8.1f} µs/output")
+    if jsonschema is None:
+        print("   jsonschema is not installed; pip install jsonschema to compare against it")
+    else:
+        base = timings["jsonschema Draft7"]
+        print(f"   Speedup over jsonschema: {base / timings['compiled']:.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate router JSON, check repair coverage and benchmark the validator")
+    parser.add_argument("--data_file", default=None, help="Raw data whose labels are validated (default: training_data.json)")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data_path = args.data_file or os.path.join(os.path.dirname(__file__), '../training_data.json')
+    with open(data_path, 'r') as f:
+        labels = [item["data"] for item in json.load(f)]
+
+    invalid = [(i, errors) for i, label in enumerate(labels) if (errors := schema_errors(label))]
+    print(f"📋 {len(labels) - len(invalid)}/{len(labels)} labels in {data_path} match the router schema")
+    for i, errors in invalid[:10]:
+        print(f"   ⚠️  #{i}: {'; '.join(errors)}")
+
+    # Repair coverage: how many corrupted outputs come back valid and equal to the original
+    rng = random.Random(args.seed)
+    valid_labels = [label for i, label in enumerate(labels) if not schema_errors(label)]
+    recovered, exact = 0, 0
+    for label in valid_labels:
+        data, errors, _ = parse_output(corrupt_output(label, rng))
+        recovered += data is not None and not errors
+        exact += data == label
+    print(f"🔧 Repair: {recovered}/{len(valid_labels)} corrupted outputs recovered schema-valid, {exact} identical to the original")
+    failed = [text for text, expected in REPAIR_CASES if parse_output(text, validator=lambda data, errors: True)[0] != expected]
+    failed += [texts for texts, expected in BATCH_CASES
+               if [data for data, _, _ in validate_batch(texts, validator=lambda data, errors: True)] != expected]
+    cases = len(REPAIR_CASES) + len(BATCH_CASES)
+    print(f"🔧 Repair cases: {cases - len(failed)}/{cases} as expected")
+    for text in failed:
+        print(f"   ⚠️  {text!r}")
+
+    if jsonschema is not None:
+        generic = jsonschema.Draft7Validator(ROUTER_JSON_SCHEMA)
+        rng = random.Random(args.seed)
+        samples = labels + [json.loads(text) for text in (corrupt_output(label, rng) for label in valid_labels)
+                            if _is_json(text)]
+        disagreements = sum(bool(schema_errors(sample)) != (not generic.is_valid(sample)) for sample in samples)
+        print(f"🔍 Agreement with jsonschema: {len(samples) - disagreements}/{len(samples)} samples")
+
+    benchmark(valid_labels, args.repeats)
+
+def _is_json(text):
+    try:
+        json.loads(text)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+import torch
+from datasets import Dataset
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from trl import SFTTrainer, SFTConfig
+from peft import LoraConfig, PeftModel
+from train_new import load_config
+from prepare_data import format_data_for_finetuning
+from dedup import deduplicate
+from constants import format_user_content
+from inteference import build_prompt
+from tiny_model import ensure_tiny_model, cpu_training_args
+from token_budget import TokenBudgetTrainer
+
+class StageTimer:
+    """Wall-clock timings per pipeline stage"""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        print(f"⏱️  {name}...")
+        start_time = time.perf_counter()
+        yield
+        self.timings[name] = time.perf_counter() - start_time
+        print(f"   done in {self.timings[name]:.2f}s")
+
+    def total(self):
+        return sum(self.timings.values())
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU end-to-end smoke test and benchmark with a tiny model")
+    parser.add_argument("--num_samples", type=int, default=32, help="Raw samples to push through the pipeline")
+    parser.add_argument("--max_steps", type=int, default=5, help="Training steps")
+    parser.add_argument("--max_seq_length", type=int, default=512)
+    parser.add_argument("--max_new_tokens", type=int, default=16)
+    parser.add_argument("--token_budget", action=argparse.BooleanOptionalAction, default=None,
+                        help="Force token-budget batching on/off (default: batching_args in the config)")
+    parser.add_argument("--output_dir", default=None, help="Keep artifacts here (default: a temp dir that is removed)")
+    parser.add_argument("--report", default=None, help="Write stage timings to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare against a previous --report file")
+    return parser.parse_args()
+
+def print_timings(timings, baseline=None):
+    print(f"\n{'Stage':<16}{'Seconds':>10}" + (f"{'Baseline':>10}{'Change':>9}" if baseline else ""))
+    print("─" * (26 + (19 if baseline else 0)))
+    for name, seconds in list(timings.items()) + [("total", sum(timings.values()))]:
+        row = f"{name:<16}{seconds:>10.2f}"
+        if baseline:
+            base = baseline.get(name) if name != "total" else sum(baseline.values())
+            if base:
+                row += f"{base:>10.2f}{100 * (seconds - base) / base:>+8.1f}%"
+        print(row)
+
+def run_smoke(args, config, work_dir):
+    timer = StageTimer()
+    raw_data_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"])
+
+    with timer.stage("build_model"):
+        model_dir = ensure_tiny_model(os.path.join(work_dir, "tiny_model"), data_path=raw_data_path)
+
+    with timer.stage("data_prep"):
+        with open(raw_data_path, 'r') as f:
+            raw_json_data = json.load(f)[:args.num_samples]
+        prompt_mode = config["dataset_config"].get("prompt_mode", "full")
+        dedup_config = config.get("dedup_config", {})
+        if dedup_config.get("enabled", False):
+            raw_json_data, _ = deduplicate(raw_json_data, prompt_chars=len(format_user_content("", prompt_mode)), **dedup_config)
+        processed_data = format_data_for_finetuning(raw_json_data, use_gemini=False, prompt_mode=prompt_mode)
+
+    with timer.stage("tokenize"):
+        tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        texts = [tokenizer.apply_chat_template(example["messages"], tokenize=False) for example in processed_data]
+        train_dataset = Dataset.from_dict({"text": texts}).map(
+            lambda batch: tokenizer(batch["text"], truncation=True, max_length=args.max_seq_length),
+            batched=True,
+            remove_columns=["text"],
+        )
+
+    with timer.stage("train"):
+        training_args = cpu_training_args(config["training_args"])
+        training_args.update({
+            "max_steps": args.max_steps,
+            "logging_steps": args.max_steps,
+            "save_strategy": "no",
+            "disable_tqdm": True,
+            "learning_rate": float(training_args["learning_rate"]),
+        })
+        batching_args = config.get("batching_args", {})
+        use_token_budget = batching_args.get("token_budget", False) if args.token_budget is None else args.token_budget
+        trainer_kwargs = {}
+        if use_token_budget:
+            training_args["gradient_accumulation_steps"] = 1
+            training_args["group_by_length"] = False
+            trainer_kwargs = {
+                "max_tokens_per_batch": max(batching_args.get("max_tokens_per_batch", 0), args.max_seq_length),
+                "tokens_per_step": batching_args.get("tokens_per_step", 8192),
+            }
+
+        model = AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=torch.float32)
+        trainer_cls = TokenBudgetTrainer if use_token_budget else SFTTrainer
+        trainer = trainer_cls(
+            model=model,
+            train_dataset=train_dataset,
+            args=SFTConfig(
+                output_dir=os.path.join(work_dir, "fine_tuned_model"),
+                max_length=args.max_seq_length,
+                packing=not use_token_budget,
+                use_cpu=True,
+                **training_args
+            ),
+            peft_config=LoraConfig(**config["lora_args"]),
+            processing_class=tokenizer,
+            **trainer_kwargs
+        )
+        if use_token_budget:
+            print(f"🧮 Token-budget batching: {trainer.budget_summary}")
+        train_result = trainer.train()
+
+    adapter_dir = os.path.join(work_dir, "fine_tuned_model")
+    with timer.stage("save_adapter"):
+        trainer.model.save_pretrained(adapter_dir)
+        tokenizer.save_pretrained(adapter_dir)
+
+    with timer.stage("inference"):
+        base_model = AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=torch.float32)
+        model = PeftModel.from_pretrained(base_model, adapter_dir).eval()
+        for item in raw_json_data[:2]:
+            prompt = build_prompt(tokenizer, item["query"], prompt_mode)
+            inputs = tokenizer(prompt, return_tensors="pt", add_special_tokens=False)
+            with torch.inference_mode():
+                model.generate(
+                    **inputs,
+                    max_new_tokens=args.max_new_tokens,
+                    do_sample=False,
+                    pad_token_id=tokenizer.pad_token_id,
+                )
+
+    print(f"📉 Training loss after {args.max_steps} steps: {train_result.training_loss:.4f}")
+    return timer.timings
+
+def main():
+    args = parse_args()
+    config = load_config()
+    if config is None:
+        return
+
+    torch.manual_seed(0)
+    work_dir = args.output_dir or tempfile.mkdtemp(prefix="smoke_")
+    os.makedirs(work_dir, exist_ok=True)
+    print(f"🧪 SMOKE MODE: tiny Gemma model on CPU, {args.num_samples} samples, {args.max_steps} steps")
+    print(f"Working directory: {work_dir}")
+    print(f"----------------------------")
+
+    try:
+        timings = run_smoke(args, config, work_dir)
+    finally:
+        if args.output_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)["timings"]
+    print_timings(timings, baseline)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({
+                "timings": timings,
+                "num_samples": args.num_samples,
+                "max_steps": args.max_steps,
+                "max_seq_length": args.max_seq_length,
+                "torch_threads": torch.get_num_threads(),
+            }, f, indent=2)
+        print(f"📁 Timings saved to: {args.report}")
+
+    print("✅ Smoke test passed!")
+
+if __name__ == "__main__":
+    main()
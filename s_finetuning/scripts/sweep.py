@@ -0,0 +1,436 @@
+import argparse
+import copy
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+import traceback
+import numpy as np
+import torch
+import yaml
+from train_new import load_config
+
+SWEEP_CONFIG_PATH = os.path.join(os.path.dirname(__file__), '../config/sweep_config.yaml')
+RANK_METRICS = {
+    # metric: higher is better
+    "field_accuracy": True,
+    "routing_exact_match": True,
+    "final_loss": False,
+    "step_time_s": False,
+    "peak_memory_mb": False,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Grid/random search over LoRA and training settings with early pruning")
+    parser.add_argument("--sweep_config", default=SWEEP_CONFIG_PATH)
+    parser.add_argument("--tiny", action="store_true", help="Use the tiny-model stand-in as the base model")
+    parser.add_argument("--cpu", action="store_true", help="Train on CPU without quantization (implied when CUDA is unavailable)")
+    parser.add_argument("--model_id", default=None, help="Override model_id from the config")
+    parser.add_argument("--num_workers", type=int, default=None,
+                        help="Trials run at once (default: one per GPU, or one per 4 CPUs)")
+    parser.add_argument("--threads_per_trial", type=int, default=None, help="Torch threads per CPU trial (default: CPUs / workers)")
+    parser.add_argument("--max_trials", type=int, default=None, help="Run only the first N trials of the search")
+    parser.add_argument("--rank_by", default="field_accuracy", choices=list(RANK_METRICS))
+    parser.add_argument("--output", default=None, help="Write all trial results to this JSON file")
+    return parser.parse_args()
+
+def set_dotted(config, path, value):
+    *parents, key = path.split(".")
+    for parent in parents:
+        config = config.setdefault(parent, {})
+    config[key] = value
+
+def sample_value(spec, rng):
+    """One random draw from a list of choices or a {low, high, log} range"""
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    low, high = spec["low"], spec["high"]
+    if spec.get("log", False):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    return round(value) if isinstance(low, int) and isinstance(high, int) else value
+
+def expand_trials(sweep_config):
+    """Parameter assignments for every trial of the grid or random search"""
+    parameters = sweep_config["parameters"]
+    method = sweep_config.get("method", "grid")
+    if method == "grid":
+        ranges = [name for name, spec in parameters.items() if not isinstance(spec, list)]
+        if ranges:
+            raise ValueError(f"Grid search needs a list of values for: {', '.join(ranges)}")
+        names = list(parameters)
+        return [dict(zip(names, values)) for values in itertools.product(*parameters.values())]
+    if method == "random":
+        rng = random.Random(sweep_config.get("seed", 0))
+        return [{name: sample_value(spec, rng) for name, spec in parameters.items()}
+                for _ in range(sweep_config.get("num_trials", 8))]
+    raise ValueError(f"Unknown sweep method: {method}")
+
+def trial_config(base_config, params):
+    config = copy.deepcopy(base_config)
+    for path, value in params.items():
+        set_dotted(config, path, value)
+    return config
+
+def peak_memory_mb(on_gpu):
+    if on_gpu:
+        return torch.cuda.max_memory_allocated() / 2**20
+    # Each trial runs in a fresh process, so the process peak is the trial's peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def make_trial_callback(trial_index, pruning, reports, lock):
+    """
+    Times optimizer steps, and reports the training loss every report_every steps to the
+    losses shared by all trials. A trial whose loss is worse than the configured
+    percentile of the other trials' losses at the same step stops early.
+    """
+    from transformers import TrainerCallback
+
+    class TrialCallback(TrainerCallback):
+        def __init__(self):
+            self.step_times = []
+            self.losses = []
+            self.pruned_at = None
+            self._step_start = None
+
+        def on_step_begin(self, args, state, control, **kwargs):
+            self._step_start = time.perf_counter()
+
+        def on_step_end(self, args, state, control, **kwargs):
+            self.step_times.append(time.perf_counter() - self._step_start)
+
+        def on_log(self, args, state, control, logs=None, **kwargs):
+            if not logs or "loss" not in logs:
+                return
+            step, loss = state.global_step, logs["loss"]
+            self.losses.append((step, loss))
+            if not pruning.get("enabled", False):
+                return
+            with lock:
+                others = [value for index, value in reports.get(step, []) if index != trial_index]
+                reports[step] = reports.get(step, []) + [(trial_index, loss)]
+            if (step >= pruning.get("warmup_steps", 0) and len(others) >= pruning.get("min_reports", 2)
+                    and loss > np.percentile(others, pruning.get("percentile", 50))):
+                self.pruned_at = step
+                control.should_training_stop = True
+
+    return TrialCallback()
+
+# GPU held by this pool worker, and the queue of free GPUs it came from
+_device = None
+_free_devices = None
+
+def init_worker(free_devices):
+    """
+    Pool initializer: claim a GPU no running trial uses (blocks until one is returned).
+    Pool workers are tied to trials, not to trial indices, so this is what keeps
+    concurrent trials on different GPUs whatever order they finish in.
+    """
+    global _device, _free_devices
+    if free_devices is not None:
+        _free_devices = free_devices
+        _device = free_devices.get()
+        torch.cuda.set_device(_device)
+
+def run_trial(task):
+    """Train and evaluate one configuration; runs in its own pool process"""
+    trial_index, params, config, job, reports, lock = task
+    result = {"trial": trial_index, "params": params, "status": "failed"}
+    try:
+        result.update(_run_trial(trial_index, config, job, reports, lock))
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    finally:
+        if _device is not None:
+            # The worker exits after this trial (maxtasksperchild=1); hand its GPU to the next one
+            torch.cuda.empty_cache()
+            _free_devices.put(_device)
+    return result
+
+def check_truncation(trial_index, tokenizer, processed, texts, max_seq_length):
+    """
+    Fail when max_seq_length cuts every sample before its JSON target (the trial would
+    train on no label tokens); warn when some samples lose part or all of it.
+    """
+    prompts = [tokenizer.apply_chat_template(example["messages"][:1], tokenize=False, add_generation_prompt=True)
+               for example in processed]
+    prompt_lengths = [len(ids) for ids in tokenizer(prompts, add_special_tokens=False)["input_ids"]]
+    lengths = [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+    no_target = sum(length >= max_seq_length for length in prompt_lengths)
+    if no_target == len(processed):
+        raise ValueError(f"max_seq_length {max_seq_length} truncates every sample before its JSON target "
+                         f"(prompts are {min(prompt_lengths)}-{max(prompt_lengths)} tokens); "
+                         f"use a shorter prompt_mode or a longer max_seq_length")
+    truncated = sum(length > max_seq_length for length in lengths)
+    if truncated:
+        print(f"⚠️  Trial {trial_index}: {truncated}/{len(processed)} samples truncated at max_seq_length {max_seq_length}, "
+              f"{no_target} of them before the JSON target")
+
+def _run_trial(trial_index, config, job, reports, lock):
+    from datasets import Dataset
+    from transformers import AutoTokenizer
+    from trl import SFTTrainer, SFTConfig
+    from peft import LoraConfig, get_peft_model
+    from constants import GEMMA_CHAT_TEMPLATE
+    from prepare_data import format_data_for_finetuning
+    from tiny_model import cpu_training_args
+    from train_distributed import load_model
+    from evaluate import evaluate_adapter
+
+    on_gpu = not job["cpu"]
+    if on_gpu:
+        device = _device
+    else:
+        device = 0
+        torch.set_num_threads(job["threads_per_trial"])
+    torch.manual_seed(job["seed"])
+    trial = job["trial"]
+    prompt_mode = config["dataset_config"].get("prompt_mode", "full")
+
+    tokenizer = AutoTokenizer.from_pretrained(job["model_id"], trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+    tokenizer.chat_template = GEMMA_CHAT_TEMPLATE
+    processed = format_data_for_finetuning(job["train_data"], use_gemini=False, prompt_mode=prompt_mode)
+    texts = [tokenizer.apply_chat_template(example["messages"], tokenize=False) for example in processed]
+    check_truncation(trial_index, tokenizer, processed, texts, trial["max_seq_length"])
+    train_dataset = Dataset.from_dict({"text": texts}).map(
+        lambda batch: tokenizer(batch["text"], truncation=True, max_length=trial["max_seq_length"]),
+        batched=True,
+        remove_columns=["text"],
+    )
+
+    training_args = config["training_args"].copy()
+    training_args["learning_rate"] = float(training_args["learning_rate"])
+    if job["cpu"]:
+        training_args = cpu_training_args(training_args)
+    training_args.update({
+        "max_steps": trial["max_steps"],
+        "logging_steps": config.get("pruning", {}).get("report_every", 5),
+        "save_strategy": "no",
+        "report_to": "none",
+        "disable_tqdm": True,
+        "seed": job["seed"],
+    })
+
+    model = load_model(job["model_id"], config, {"local_rank": device}, job["cpu"])
+    if training_args.get("gradient_checkpointing"):
+        model.config.use_cache = False
+    model = get_peft_model(model, LoraConfig(**config["lora_args"]))
+    trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+    callback = make_trial_callback(trial_index, config.get("pruning", {}), reports, lock)
+    trainer = SFTTrainer(
+        model=model,
+        train_dataset=train_dataset,
+        args=SFTConfig(
+            output_dir=os.path.join(job["work_dir"], f"trial_{trial_index}"),
+            max_length=trial["max_seq_length"],
+            packing=True,
+            use_cpu=job["cpu"],
+            gradient_checkpointing_kwargs={"use_reentrant": False},
+            **training_args
+        ),
+        processing_class=tokenizer,
+        callbacks=[callback],
+    )
+    print(f"🚀 Trial {trial_index}: {trainable_params:,} trainable parameters")
+    trainer.train()
+
+    # The first step includes one-off setup (allocator warm-up, lazy init), so it is left out
+    step_times = callback.step_times[1:] or callback.step_times
+    result = {
+        "status": "pruned" if callback.pruned_at is not None else "completed",
+        "steps": len(callback.step_times),
+        "final_loss": callback.losses[-1][1] if callback.losses else None,
+        "losses": callback.losses,
+        "step_time_s": statistics.median(step_times),
+        "trainable_params": trainable_params,
+    }
+    if callback.pruned_at is not None:
+        # Pruned trials skip evaluation, which is most of what pruning saves
+        result["peak_memory_mb"] = peak_memory_mb(on_gpu)
+        return result
+
+    model = trainer.model.eval()
+    metrics = evaluate_adapter(model, tokenizer, job["eval_data"], prompt_mode, 8, trial["max_new_tokens"])
+    result.update({
+        "peak_memory_mb": peak_memory_mb(on_gpu),
+        "valid_json": metrics["valid_json"],
+        "routing_exact_match": metrics["routing_exact_match"],
+        "field_accuracy": statistics.mean(metrics["field_accuracy"].values()),
+        "eval_seconds_per_sample": metrics["seconds_per_sample"],
+    })
+    return result
+
+def load_sweep_data(config, trial):
+    """Training and held-out raw samples, split and deduplicated as in prepare_data.py"""
+    from prepare_data import load_raw_data, split_eval
+    from dedup import deduplicate
+    from constants import format_user_content
+
+    raw_data_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"])
+    raw_data = load_raw_data(raw_data_path)
+    dedup_config = config.get("dedup_config", {})
+    if dedup_config.get("enabled", False):
+        prompt_mode = config["dataset_config"].get("prompt_mode", "full")
+        raw_data, _ = deduplicate(raw_data, prompt_chars=len(format_user_content("", prompt_mode)), **dedup_config)
+    # Trials are always scored on held-out samples, even if the config disables the split
+    train_data, eval_data = split_eval(raw_data, config["dataset_config"].get("eval_fraction") or 0.1)
+    return train_data[:trial.get("num_train_samples")], eval_data[:trial.get("num_eval_samples")]
+
+def rank_results(results, rank_by):
+    """Completed trials by rank_by (ties broken by final loss), then pruned, then failed"""
+    higher_is_better = RANK_METRICS[rank_by]
+
+    def key(result):
+        status_order = {"completed": 0, "pruned": 1, "failed": 2}[result["status"]]
+        value = result.get(rank_by)
+        value = math.inf if value is None else (-value if higher_is_better else value)
+        loss = result.get("final_loss")
+        return status_order, value, math.inf if loss is None else loss
+    return sorted(results, key=key)
+
+def format_params(params):
+    def fmt(value):
+        if isinstance(value, list):
+            return json.dumps(value)
+        return f"{value:.3g}" if isinstance(value, float) else value
+    return ", ".join(f"{path.split('.')[-1]}={fmt(value)}" for path, value in params.items())
+
+def print_table(ranked, rank_by):
+    def fmt(value, spec):
+        return "-" if value is None else format(value, spec)
+
+    print(f"\n🏁 Sweep results (ranked by {rank_by})")
+    header = (f"{'#':>3} {'trial':>5} {'status':>9} {'field acc':>9} {'exact':>6} {'valid':>6} {'loss':>7} "
+              f"{'step s':>7} {'peak MB':>8} {'trainable':>10}  params")
+    print(header)
+    print("─" * len(header))
+    for rank, r in enumerate(ranked, 1):
+        print(f"{rank:>3} {r['trial']:>5} {r['status']:>9} {fmt(r.get('field_accuracy'), '.1%'):>9} "
+              f"{fmt(r.get('routing_exact_match'), '.1%'):>6} {fmt(r.get('valid_json'), '.0%'):>6} "
+              f"{fmt(r.get('final_loss'), '.3f'):>7} {fmt(r.get('step_time_s'), '.3f'):>7} "
+              f"{fmt(r.get('peak_memory_mb'), '.0f'):>8} {fmt(r.get('trainable_params'), ','):>10}  "
+              f"{format_params(r['params'])}")
+    for r in ranked:
+        if r["status"] == "failed":
+            print(f"❌ Trial {r['trial']} failed: {r.get('error')}")
+
+def run_pool(ctx, config, trials, job, num_workers):
+    """
+    Run the trials num_workers at a time. Trials share their loss reports through a manager
+    process; each trial gets a fresh worker process (maxtasksperchild=1), so its peak
+    memory and CUDA state are its own. On GPU every worker takes a device from a shared
+    queue of free GPUs and returns it when its trial ends.
+    """
+    with ctx.Manager() as manager:
+        reports, lock = manager.dict(), manager.Lock()
+        free_devices = None
+        if not job["cpu"]:
+            free_devices = manager.Queue()
+            for device in range(torch.cuda.device_count()):
+                free_devices.put(device)
+        tasks = [(i, params, trial_config(config, params), job, reports, lock) for i, params in enumerate(trials)]
+        results = []
+        with ctx.Pool(num_workers, initializer=init_worker, initargs=(free_devices,), maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(run_trial, tasks):
+                results.append(result)
+                detail = {"pruned": f" at step {result.get('steps')}", "failed": f": {result.get('error')}"}.get(result["status"], "")
+                print(f"✅ Trial {result['trial']} {result['status']}{detail} ({len(results)}/{len(tasks)})")
+    return results
+
+def main():
+    args = parse_args()
+    config = load_config()
+    if config is None:
+        return
+    if not os.path.exists(args.sweep_config):
+        print(f"❌ Error: Sweep config {args.sweep_config} does not exist.")
+        return
+    with open(args.sweep_config, 'r') as f:
+        sweep_config = yaml.safe_load(f)
+
+    try:
+        trials = expand_trials(sweep_config)[:args.max_trials]
+    except ValueError as e:
+        print(f"❌ Error: {e}")
+        return
+    trial = sweep_config.get("trial", {})
+    trial.setdefault("max_steps", 30)
+    trial.setdefault("max_seq_length", config["dataset_config"]["max_seq_length"])
+    trial.setdefault("max_new_tokens", 128)
+    if trial.get("prompt_mode"):
+        config["dataset_config"]["prompt_mode"] = trial["prompt_mode"]
+    config["pruning"] = sweep_config.get("pruning", {})
+
+    cpu = args.cpu or not torch.cuda.is_available()
+    if args.tiny:
+        from tiny_model import ensure_tiny_model
+        model_id = ensure_tiny_model(data_path=os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"]))
+    else:
+        model_id = args.model_id or config["model_id"]
+    num_workers = args.num_workers or ((os.cpu_count() or 1) // 4 if cpu else torch.cuda.device_count())
+    if not cpu:
+        # One trial per GPU; extra workers would only wait for a free device
+        num_workers = min(num_workers, torch.cuda.device_count())
+    num_workers = max(1, min(num_workers, len(trials)))
+    threads_per_trial = args.threads_per_trial or max(1, (os.cpu_count() or 1) // num_workers)
+
+    train_data, eval_data = load_sweep_data(config, trial)
+    # Trials keep nothing on disk (no checkpoints, adapters are scored in memory)
+    work_dir = tempfile.mkdtemp(prefix="sweep_")
+    job = {
+        "model_id": model_id,
+        "cpu": cpu,
+        "threads_per_trial": threads_per_trial,
+        "seed": sweep_config.get("seed", 0),
+        "trial": trial,
+        "train_data": train_data,
+        "eval_data": eval_data,
+        "work_dir": work_dir,
+    }
+
+    print(f"🔎 SWEEP: {len(trials)} trials ({sweep_config.get('method', 'grid')}), {num_workers} at a time "
+          f"on {'CPU' if cpu else 'GPU'}" + (f" with {threads_per_trial} threads each" if cpu else ""))
+    print(f"Model ID: {model_id}")
+    print(f"Data: {len(train_data)} train / {len(eval_data)} eval samples, {trial['max_steps']} steps per trial, "
+          f"prompt_mode {config['dataset_config'].get('prompt_mode', 'full')}, max_seq_length {trial['max_seq_length']}")
+    print(f"----------------------------")
+
+    ctx = mp.get_context("spawn")
+    start_time = time.perf_counter()
+    try:
+        results = run_pool(ctx, config, trials, job, num_workers)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    wall_time = time.perf_counter() - start_time
+
+    ranked = rank_results(results, args.rank_by)
+    print_table(ranked, args.rank_by)
+    pruned = sum(r["status"] == "pruned" for r in results)
+    print(f"\n⏱️  {len(results)} trials in {wall_time:.1f}s ({pruned} pruned early)")
+
+    best = ranked[0] if ranked and ranked[0]["status"] == "completed" else None
+    if best:
+        print("\n✅ Best settings for fine_tune_config.yaml:")
+        print(yaml.safe_dump(trial_config({}, best["params"]), default_flow_style=False, sort_keys=False).rstrip())
+        print(f"   (trained with prompt_mode {config['dataset_config'].get('prompt_mode', 'full')})")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"sweep_config": sweep_config, "rank_by": args.rank_by, "results": ranked}, f, indent=2)
+        print(f"📁 Sweep results saved to: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import json
+import os
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import Gemma3ForCausalLM, Gemma3TextConfig, PreTrainedTokenizerFast
+from constants import PROMPT_MODES, GEMMA_CHAT_TEMPLATE
+
+# Special tokens used by the Gemma chat template
+SPECIAL_TOKENS = ["<pad>", "<eos>", "<bos>", "<unk>", "<start_of_turn>", "<end_of_turn>"]
+
+# Small enough to train a few steps on a laptop CPU in seconds
+TINY_MODEL_ARGS = {
+    "hidden_size": 64,
+    "intermediate_size": 128,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "head_dim": 16,
+    "max_position_embeddings": 8192,
+    "sliding_window": 512,
+}
+
+# Settings that only make sense on a CUDA box (bitsandbytes, bf16, paged optimizers)
+CPU_TRAINING_OVERRIDES = {
+    "optim": "adamw_torch",
+    "bf16": False,
+    "fp16": False,
+    "gradient_checkpointing": False,
+    "report_to": "none",
+}
+
+def default_tiny_model_dir():
+    """Default location of the locally built tiny model"""
+    return os.path.join(os.path.dirname(__file__), '..', 'tiny_model')
+
+def cpu_training_args(training_args):
+    """Return a copy of the training args that can run on CPU"""
+    cpu_args = training_args.copy()
+    cpu_args.update(CPU_TRAINING_OVERRIDES)
+    return cpu_args
+
+def load_tokenizer_corpus(data_path):
+    """Collect queries, expected outputs and the system prompt variants to train the tiny tokenizer on"""
+    texts = list(PROMPT_MODES.values())
+    if data_path and os.path.exists(data_path):
+        with open(data_path, 'r') as f:
+            raw_data = json.load(f)
+        for item in raw_data:
+            texts.append(item["query"])
+            texts.append(json.dumps(item["data"], separators=(',', ':')))
+    return texts
+
+def build_tiny_tokenizer(texts, vocab_size=4096):
+    """Train a small byte-level BPE tokenizer with the Gemma special tokens"""
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    )
+    tokenizer.train_from_iterator(texts, trainer=trainer)
+
+    hf_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        eos_token="<eos>",
+        bos_token="<bos>",
+        unk_token="<unk>",
+        additional_special_tokens=["<start_of_turn>", "<end_of_turn>"],
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    hf_tokenizer.padding_side = "right"
+    hf_tokenizer.chat_template = GEMMA_CHAT_TEMPLATE
+    return hf_tokenizer
+
+def build_tiny_model(tokenizer, seed=0):
+    """Build a randomly initialized Gemma-3 architecture model matching the tokenizer"""
+    torch.manual_seed(seed)
+    config = Gemma3TextConfig(
+        vocab_size=len(tokenizer),
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        **TINY_MODEL_ARGS,
+    )
+    return Gemma3ForCausalLM(config)
+
+def ensure_tiny_model(model_dir=None, data_path=None, vocab_size=4096, seed=0):
+    """
+    Build (or reuse) a tiny Gemma model and tokenizer on disk.
+    Returns the directory, which can be passed anywhere a model_id is expected.
+    """
+    model_dir = model_dir or default_tiny_model_dir()
+    if os.path.exists(os.path.join(model_dir, "config.json")):
+        return model_dir
+
+    print(f"🧱 Building tiny Gemma model in {model_dir}...")
+    tokenizer = build_tiny_tokenizer(load_tokenizer_corpus(data_path), vocab_size=vocab_size)
+    model = build_tiny_model(tokenizer, seed=seed)
+    model.save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    print(f"✅ Tiny model saved ({sum(p.numel() for p in model.parameters()):,} parameters)")
+    return model_dir
+
+if __name__ == "__main__":
+    raw_data_path = os.path.join(os.path.dirname(__file__), '../training_data.json')
+    ensure_tiny_model(data_path=raw_data_path)
@@ -0,0 +1,146 @@
+import random
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, Sampler
+from trl import SFTTrainer
+
+def plan_micro_batches(lengths, max_tokens_per_batch):
+    """
+    Group sample indices into micro-batches whose padded size (batch size x longest sample)
+    stays within max_tokens_per_batch. Samples are sorted by length first so that
+    short samples share a batch instead of being padded up to a long one.
+    """
+    if max(lengths) > max_tokens_per_batch:
+        raise ValueError(
+            f"max_tokens_per_batch ({max_tokens_per_batch}) is smaller than the longest sample "
+            f"({max(lengths)} tokens); raise it to at least max_seq_length"
+        )
+
+    micro_batches, current, longest = [], [], 0
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        new_longest = max(longest, lengths[index])
+        if current and new_longest * (len(current) + 1) > max_tokens_per_batch:
+            micro_batches.append(current)
+            current, new_longest = [], lengths[index]
+        current.append(index)
+        longest = new_longest
+    if current:
+        micro_batches.append(current)
+    return micro_batches
+
+def plan_steps(lengths, max_tokens_per_batch, tokens_per_step, seed=42):
+    """
+    Group micro-batches into optimizer steps holding ~tokens_per_step real tokens each.
+    The number of micro-batches per step (the gradient accumulation) varies with
+    sample length, so every optimizer step sees about the same number of tokens.
+    """
+    micro_batches = plan_micro_batches(lengths, max_tokens_per_batch)
+    random.Random(seed).shuffle(micro_batches)
+
+    steps, current, current_tokens = [], [], 0
+    for micro_batch in micro_batches:
+        current.append(micro_batch)
+        current_tokens += sum(lengths[i] for i in micro_batch)
+        if current_tokens >= tokens_per_step:
+            steps.append(current)
+            current, current_tokens = [], 0
+    if current:
+        steps.append(current)
+    return steps
+
+def summarize_plan(steps, lengths, max_tokens_per_batch):
+    micro_batches = [mb for step in steps for mb in step]
+    real_tokens = sum(lengths)
+    padded_tokens = sum(len(mb) * max(lengths[i] for i in mb) for mb in micro_batches)
+    step_tokens = [sum(lengths[i] for mb in step for i in mb) for step in steps]
+    return {
+        "optimizer_steps": len(steps),
+        "micro_batches": len(micro_batches),
+        "accumulation_range": (min(len(s) for s in steps), max(len(s) for s in steps)),
+        "batch_size_range": (min(len(mb) for mb in micro_batches), max(len(mb) for mb in micro_batches)),
+        "tokens_per_step_range": (min(step_tokens), max(step_tokens)),
+        "padding_efficiency": real_tokens / padded_tokens,
+        "budget_utilization": padded_tokens / (len(micro_batches) * max_tokens_per_batch),
+    }
+
+class TokenBudgetStepDataset(Dataset):
+    """Each item is one optimizer step: a list of micro-batches, each a list of samples"""
+
+    def __init__(self, dataset, steps):
+        self.dataset = dataset
+        self.steps = steps
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, index):
+        return [[self.dataset[i] for i in micro_batch] for micro_batch in self.steps[index]]
+
+class EpochShuffleSampler(Sampler):
+    """Shuffles the order of optimizer steps with a seed derived from the current epoch"""
+
+    def __init__(self, num_steps, seed, get_epoch):
+        self.num_steps = num_steps
+        self.seed = seed
+        self.get_epoch = get_epoch
+
+    def __len__(self):
+        return self.num_steps
+
+    def __iter__(self):
+        order = list(range(self.num_steps))
+        random.Random(self.seed + self.get_epoch()).shuffle(order)
+        return iter(order)
+
+class TokenBudgetTrainer(SFTTrainer):
+    """
+    SFTTrainer whose optimizer steps are built from a token budget instead of a fixed
+    per_device_train_batch_size x gradient_accumulation_steps. Each dataloader item
+    holds all micro-batches of one optimizer step; training_step accumulates over
+    them and weights each micro-batch loss by its share of the step's label tokens.
+    Run it with gradient_accumulation_steps=1 and packing=False.
+    """
+
+    def __init__(self, *args, max_tokens_per_batch=4096, tokens_per_step=16384, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.args.world_size > 1:
+            raise ValueError("Token-budget batching is single-process only; use train_distributed.py for DDP")
+        if self.args.gradient_accumulation_steps != 1:
+            raise ValueError("Token-budget batching sets the accumulation itself; use gradient_accumulation_steps=1")
+
+        lengths = [len(ids) for ids in self.train_dataset["input_ids"]]
+        self.budget_steps = plan_steps(lengths, max_tokens_per_batch, tokens_per_step, seed=self.args.seed)
+        self.budget_summary = summarize_plan(self.budget_steps, lengths, max_tokens_per_batch)
+
+    def get_train_dataloader(self):
+        step_dataset = TokenBudgetStepDataset(self.train_dataset, self.budget_steps)
+        sampler = EpochShuffleSampler(
+            len(step_dataset),
+            self.args.seed,
+            lambda: int((self.state.epoch or 0) + 1e-6),
+        )
+        # Batches of one step rather than batch_size=None: resuming skips the steps already
+        # trained with skip_first_batches, which needs a batch_sampler to skip over
+        return DataLoader(
+            step_dataset,
+            batch_sampler=BatchSampler(sampler, batch_size=1, drop_last=False),
+            collate_fn=lambda batch: {"micro_batches": [self.data_collator(mb) for mb in batch[0]]},
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def training_step(self, model, inputs, num_items_in_batch=None):
+        model.train()
+        micro_batches = inputs["micro_batches"]
+        label_tokens = [int((mb["labels"][..., 1:] != -100).sum()) for mb in micro_batches]
+        step_tokens = max(sum(label_tokens), 1)
+
+        total_loss = torch.zeros((), device=self.args.device)
+        for micro_batch, tokens in zip(micro_batches, label_tokens):
+            micro_batch = self._prepare_inputs(micro_batch)
+            with self.compute_loss_context_manager():
+                loss = self.compute_loss(model, micro_batch)
+            loss = loss * (tokens / step_tokens)
+            self.accelerator.backward(loss)
+            total_loss += loss.detach()
+            del micro_batch
+        return total_loss
@@ -0,0 +1,204 @@
+import argparse
+import os
+import torch
+from datasets import load_dataset
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from trl import SFTTrainer, SFTConfig
+from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+from train_new import load_config, format_chat_template
+from constants import GEMMA_CHAT_TEMPLATE
+from tiny_model import ensure_tiny_model, cpu_training_args
+from checkpointing import AsyncAdapterCheckpointCallback, resolve_resume_checkpoint
+from inteference import save_router_config
+from date_shift import build_date_shift_dataset
+
+# Hugging Face token for accessing gated models
+HF_TOKEN = os.environ.get("HF_TOKEN", "")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Distributed data-parallel QLoRA fine-tuning")
+    parser.add_argument("--cpu", action="store_true", help="Train on CPU with the gloo backend (no quantization)")
+    parser.add_argument("--tiny", action="store_true", help="Use a locally built tiny Gemma model instead of model_id")
+    parser.add_argument("--model_id", default=None, help="Override model_id from the config")
+    parser.add_argument("--data_file", default=None, help="Override the processed (chat formatted) data file")
+    parser.add_argument("--output_dir", default=None, help="Override output_dir from the config")
+    parser.add_argument("--prompt_mode", default=None, help="Prompt mode the data file was prepared with (default: dataset_config.prompt_mode)")
+    parser.add_argument("--date_shift", action="store_true",
+                        help="Stream the raw data with a fresh random current date per example and epoch (default: date_shift_args.enabled)")
+    parser.add_argument("--max_steps", type=int, default=None, help="Override max_steps from the config")
+    parser.add_argument("--max_seq_length", type=int, default=None, help="Override max_seq_length from the config")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        help="Resume from a checkpoint directory (default: the latest one in output_dir)")
+    return parser.parse_args()
+
+def get_dist_info():
+    """Rank information exported by torchrun / accelerate launch"""
+    return {
+        "rank": int(os.environ.get("RANK", 0)),
+        "local_rank": int(os.environ.get("LOCAL_RANK", 0)),
+        "world_size": int(os.environ.get("WORLD_SIZE", 1)),
+    }
+
+def rank0_print(*args):
+    if int(os.environ.get("RANK", 0)) == 0:
+        print(*args)
+
+def load_model(model_id, config, dist_info, cpu):
+    """
+    Load one full model replica per process.
+    device_map="auto" would shard a single replica across all GPUs, which cannot be
+    combined with DDP, so each rank pins its replica to its own device instead.
+    """
+    if cpu:
+        return AutoModelForCausalLM.from_pretrained(
+            model_id,
+            torch_dtype=torch.float32,
+            token=HF_TOKEN,
+            trust_remote_code=True,
+        )
+
+    quant_config = BitsAndBytesConfig(**config["quantization_args"])
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id,
+        device_map={"": dist_info["local_rank"]},
+        quantization_config=quant_config,
+        token=HF_TOKEN,
+        trust_remote_code=True,
+    )
+    return prepare_model_for_kbit_training(
+        model,
+        use_gradient_checkpointing=config["training_args"].get("gradient_checkpointing", False),
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+    )
+
+def main():
+    args = parse_args()
+    dist_info = get_dist_info()
+
+    config = load_config()
+    if config is None:
+        return
+
+    model_id = args.model_id or config["model_id"]
+    output_dir = args.output_dir or os.path.join(os.path.dirname(__file__), '..', config["output_dir"])
+    data_path = args.data_file or os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["processed_data_output"])
+    max_seq_length = args.max_seq_length or config["dataset_config"]["max_seq_length"]
+    prompt_mode = args.prompt_mode or config["dataset_config"].get("prompt_mode", "full")
+    date_shift = args.date_shift or config.get("date_shift_args", {}).get("enabled", False)
+
+    if not date_shift and not os.path.exists(data_path):
+        rank0_print(f"❌ Error: Data file {data_path} does not exist. Run prepare_data.py first.")
+        return
+
+    # Training arguments from config
+    training_args = config["training_args"].copy()
+    if isinstance(training_args["learning_rate"], str):
+        training_args["learning_rate"] = float(training_args["learning_rate"])
+    if args.cpu:
+        training_args = cpu_training_args(training_args)
+    if args.max_steps is not None:
+        training_args["max_steps"] = args.max_steps
+    if date_shift:
+        # Lengths of streamed examples are not known up front
+        training_args["group_by_length"] = False
+
+    # Step-based adapter-only checkpoints replace the Trainer's full checkpoints
+    callbacks = []
+    checkpoint_args = config.get("checkpoint_args")
+    if checkpoint_args:
+        training_args["save_strategy"] = "no"
+        callbacks.append(AsyncAdapterCheckpointCallback(output_dir, **checkpoint_args))
+
+    sft_config = SFTConfig(
+        output_dir=output_dir,
+        max_length=max_seq_length,
+        # Streamed examples are already tokenized per epoch, so they skip trl's preprocessing and packing
+        packing=not date_shift,
+        dataset_text_field="text",
+        dataset_kwargs={"skip_prepare_dataset": True} if date_shift else None,
+        use_cpu=args.cpu,
+        ddp_backend=("gloo" if args.cpu else "nccl") if dist_info["world_size"] > 1 else None,
+        # Only the LoRA parameters require grad, so every parameter DDP tracks is used
+        ddp_find_unused_parameters=False,
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        **training_args
+    )
+
+    if args.tiny:
+        # Built once per node by the local main process; the other ranks wait and reuse it
+        raw_data_path = os.path.join(os.path.dirname(__file__), '..', config["dataset_config"]["data_file"])
+        with sft_config.main_process_first(desc="building tiny model"):
+            model_id = ensure_tiny_model(data_path=raw_data_path)
+
+    rank0_print(f"🔧 Distributed Configuration:")
+    rank0_print(f"Model ID: {model_id}")
+    rank0_print(f"Output Directory: {output_dir}")
+    rank0_print(f"Data File: {'date-shifted ' + config['dataset_config']['data_file'] if date_shift else data_path}")
+    rank0_print(f"World Size: {dist_info['world_size']}")
+    rank0_print(f"Backend: {'gloo (CPU)' if args.cpu else 'nccl (GPU)'}")
+    rank0_print(f"----------------------------")
+
+    # Load tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True, token=HF_TOKEN)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+    tokenizer.chat_template = GEMMA_CHAT_TEMPLATE
+
+    if date_shift:
+        # Accelerate reads the stream on rank 0 and dispatches each batch's slices to the other ranks
+        train_dataset = build_date_shift_dataset(config, tokenizer, max_seq_length, prompt_mode)
+        rank0_print(f"📅 Date shift: dates sampled from {train_dataset.start_date} to {train_dataset.end_date}, new per epoch")
+    else:
+        # Format on the main process first so the other ranks can reuse the datasets cache
+        with sft_config.main_process_first(desc="formatting dataset"):
+            dataset = load_dataset("json", data_files=data_path, split='train')
+            train_dataset = dataset.map(
+                lambda x: format_chat_template(x, tokenizer),
+                batched=True,
+                remove_columns=dataset.column_names,
+            )
+
+    # The Trainer wraps the dataset in a DistributedSampler: each rank sees 1/world_size of it per epoch
+    shard_size = -(-len(train_dataset) // dist_info["world_size"])
+    rank0_print(f"📊 Dataset: {len(train_dataset)} samples, ~{shard_size} per rank")
+
+    model = load_model(model_id, config, dist_info, args.cpu)
+    if training_args.get("gradient_checkpointing"):
+        model.config.use_cache = False
+
+    # Apply LoRA before DDP wraps the model so that DDP only buckets (and all-reduces) adapter gradients
+    model = get_peft_model(model, LoraConfig(**config["lora_args"]))
+    synced_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    total_params = sum(p.numel() for p in model.parameters())
+    rank0_print(f"🔁 Gradients synced per step: {synced_params:,} of {total_params:,} parameters "
+                f"({100 * synced_params / total_params:.3f}%)")
+
+    trainer = SFTTrainer(
+        model=model,
+        train_dataset=train_dataset,
+        args=sft_config,
+        processing_class=tokenizer,
+        callbacks=callbacks,
+    )
+
+    resume_checkpoint = resolve_resume_checkpoint(args.resume, output_dir)
+    if resume_checkpoint:
+        rank0_print(f"⏩ Resuming from {resume_checkpoint}")
+
+    rank0_print("🎯 Starting distributed training...")
+    trainer.train(resume_from_checkpoint=resume_checkpoint)
+
+    # Every rank holds identical adapters after the final all-reduce; write them once
+    trainer.accelerator.wait_for_everyone()
+    if trainer.is_world_process_zero():
+        print(f"💾 Saving LoRA adapters to {output_dir}...")
+        trainer.model.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
+        save_router_config(output_dir, prompt_mode)
+        print("✅ Distributed training completed successfully!")
+        print(f"📁 Adapters saved to: {output_dir}")
+    trainer.accelerator.wait_for_everyone()
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import argparse
 import torch
 import yaml
 import os
@@ -5,6 +6,10 @@ from datasets import load_dataset
 from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 from trl import SFTTrainer, SFTConfig
 from peft import LoraConfig, prepare_model_for_kbit_training
+from checkpointing import AsyncAdapterCheckpointCallback, resolve_resume_checkpoint
+from token_budget import TokenBudgetTrainer
+from inteference import save_router_config
+from date_shift import build_date_shift_dataset
 
 # Hugging Face token for accessing gated models
 HF_TOKEN = os.environ.get("HF_TOKEN", "")
@@ -45,7 +50,15 @@ def format_chat_template(batch, tokenizer):
     
     return {"text": samples}
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="QLoRA fine-tuning")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        help="Resume from a checkpoint directory (default: the latest one in output_dir)")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+
     # Load configuration
     config = load_config()
     if config is None:
@@ -130,32 +143,73 @@ def main():
     training_args = config["training_args"].copy()
     if isinstance(training_args["learning_rate"], str):
         training_args["learning_rate"] = float(training_args["learning_rate"])
+
+    # Step-based adapter-only checkpoints replace the Trainer's full checkpoints
+    callbacks = []
+    checkpoint_args = config.get("checkpoint_args")
+    if checkpoint_args:
+        training_args["save_strategy"] = "no"
+        callbacks.append(AsyncAdapterCheckpointCallback(output_dir, **checkpoint_args))
+
+    # Date-shifted examples are streamed from the raw data instead of the test file, re-dated every epoch
+    date_shift = config.get("date_shift_args", {}).get("enabled", False)
+    if date_shift:
+        train_dataset = build_date_shift_dataset(config, tokenizer, config["dataset_config"]["max_seq_length"])
+        print(f"📅 Date shift: streaming {len(train_dataset)} raw samples, dates from {train_dataset.start_date} to {train_dataset.end_date}")
+        training_args["group_by_length"] = False
+
+    # Token-budget batching builds each optimizer step itself, so it replaces packing and fixed accumulation
+    batching_args = config.get("batching_args", {})
+    use_token_budget = batching_args.get("token_budget", False)
+    if use_token_budget and date_shift:
+        print("⚠️  Token-budget batching needs a map-style dataset; disabled for the date-shift stream")
+        use_token_budget = False
+    trainer_kwargs = {}
+    if use_token_budget:
+        training_args["gradient_accumulation_steps"] = 1
+        training_args["group_by_length"] = False
+        trainer_kwargs = {
+            "max_tokens_per_batch": batching_args["max_tokens_per_batch"],
+            "tokens_per_step": batching_args["tokens_per_step"],
+        }
     
     # Create SFT config
     sft_config = SFTConfig(
         output_dir=output_dir,
+        max_length=config["dataset_config"]["max_seq_length"],
+        packing=not (use_token_budget or date_shift),
+        dataset_text_field="text",
+        dataset_kwargs={"skip_prepare_dataset": True} if date_shift else None,
         **training_args
     )
     
     # Initialize trainer
     print("🚀 Initializing SFTTrainer...")
-    trainer = SFTTrainer(
+    trainer_cls = TokenBudgetTrainer if use_token_budget else SFTTrainer
+    trainer = trainer_cls(
         model=model,
         train_dataset=train_dataset,
         args=sft_config,
         peft_config=peft_config,
-        max_seq_length=config["dataset_config"]["max_seq_length"],
-        tokenizer=tokenizer,
-        packing=True,
+        processing_class=tokenizer,
+        callbacks=callbacks,
+        **trainer_kwargs
     )
+    if use_token_budget:
+        print(f"🧮 Token-budget batching: {trainer.budget_summary}")
+
+    resume_checkpoint = resolve_resume_checkpoint(args.resume, output_dir)
+    if resume_checkpoint:
+        print(f"⏩ Resuming from {resume_checkpoint}")
     
     print("🎯 Starting training...")
-    trainer.train()
+    trainer.train(resume_from_checkpoint=resume_checkpoint)
     
     print(f"💾 Saving model to {output_dir}...")
     trainer.save_model(output_dir)
     trainer.model.save_pretrained(os.path.join(output_dir, "final_model"))
     tokenizer.save_pretrained(output_dir)
+    save_router_config(output_dir, config["dataset_config"].get("prompt_mode", "full"))
     
     print("✅ Training completed successfully!")
     print(f"📁 Model saved to: {output_dir}")